@@ -0,0 +1,294 @@
+"""Throughput benchmark for download.py against a local stand-in server.
+
+Starts a StandInServer with the given file scale, latency and bandwidth
+(and optionally total capacity and a limit on concurrent transfers),
+runs download.py once per mode into a fresh directory, and reports wall
+time, throughput, peak RSS and CPU time per MB. Results are appended to a
+JSON file so runs can be compared over time.
+
+    python bench.py --scale 0.1 --latency 0.05 --bandwidth 4M
+    python bench.py --mode jobs-16="-j 16" --repeat 3
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from download import parse_size
+from standin import StandInServer
+
+DOWNLOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "download.py")
+RESULTS_FILE = "bench_results.json"
+
+MODES = {
+    "sequential": [],
+    "jobs-4": ["-j", "4"],
+    "jobs-8": ["-j", "8"],
+    "segments-4": ["--segments", "4"],
+    "asyncio-8": ["--engine", "asyncio", "-j", "8"],
+}
+
+MB = 1024 * 1024
+RSS_INTERVAL = 0.02
+
+
+def parse_mode(value):
+    """Argparse type for --mode NAME="ARGS"."""
+    name, _, arguments = value.partition("=")
+    if not name:
+        raise argparse.ArgumentTypeError(f"Invalid mode: {value}")
+    return name, shlex.split(arguments)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark download.py against a local stand-in server",
+    )
+    parser.add_argument(
+        "--mode",
+        type=parse_mode,
+        action="append",
+        dest="modes",
+        metavar='NAME="ARGS"',
+        help='Downloader mode to run, e.g. jobs-16="-j 16"; may be repeated '
+        f"(default: {', '.join(MODES)})",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=0.1,
+        help="Multiply realistic file sizes by this factor (default: 0.1)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="Server delay before each response (default: 0)",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=parse_size,
+        metavar="RATE",
+        help="Server bytes per second per connection, e.g. 4M (default: unlimited)",
+    )
+    parser.add_argument(
+        "--capacity",
+        type=parse_size,
+        metavar="RATE",
+        help="Server bytes per second on all connections together, e.g. 8M "
+        "(default: unlimited)",
+    )
+    parser.add_argument(
+        "--max-active",
+        type=int,
+        metavar="N",
+        help="Server answers 503 beyond N transfers at once (default: no limit)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Run each mode N times and report the median (default: 1)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=RESULTS_FILE,
+        help=f"JSON file to append results to (default: {RESULTS_FILE})",
+    )
+    return parser.parse_args()
+
+
+def peak_rss(pid):
+    """Return the peak RSS of a running process in bytes, or None if unknown.
+
+    Read from /proc, which only exists on Linux.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_downloader(arguments, output_dir):
+    """Run download.py to completion and measure it.
+
+    Resource usage comes from wait4 on the child, so CPU time is that of the
+    downloader alone, not of this process or the server. On Linux, ru_maxrss
+    of a child starts from its parent's RSS when it was forked, which here
+    includes the server, so peak RSS is sampled from /proc while it runs.
+    """
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, DOWNLOADER, "-o", output_dir, *arguments],
+        stdout=subprocess.DEVNULL,
+    )
+    peak = None
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        rss = peak_rss(process.pid)
+        if rss is not None:
+            peak = max(peak or 0, rss)
+        time.sleep(RSS_INTERVAL)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.monotonic() - started
+
+    received = sum(
+        entry.stat().st_size for entry in os.scandir(output_dir) if entry.is_file()
+    )
+    if peak is None:
+        # ru_maxrss is in kilobytes on Linux but bytes on macOS
+        peak = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    cpu = usage.ru_utime + usage.ru_stime
+    return {
+        "exit_code": process.returncode,
+        "wall_seconds": wall,
+        "bytes": received,
+        "throughput_mb_s": received / MB / wall if wall else 0.0,
+        "peak_rss_mb": peak / MB,
+        "cpu_seconds": cpu,
+        "cpu_seconds_per_mb": cpu / (received / MB) if received else None,
+    }
+
+
+def run_mode(server, name, arguments, repeat):
+    """Run one mode `repeat` times and return the median of each measurement."""
+    runs = []
+    for _ in range(repeat):
+        output_dir = tempfile.mkdtemp(prefix="flp_bench_")
+        try:
+            runs.append(
+                run_downloader(["--base-url", server.url, *arguments], output_dir)
+            )
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    result = {"mode": name, "args": arguments, "runs": len(runs)}
+    for key in runs[0]:
+        values = [run[key] for run in runs if run[key] is not None]
+        result[key] = statistics.median(values) if values else None
+    result["exit_code"] = max(run["exit_code"] for run in runs)
+    return result
+
+
+def git_commit():
+    """Return the current git commit of the downloader, if available."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(DOWNLOADER),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def previous_result(history, config, mode):
+    """Find the latest earlier result for `mode` under the same server config."""
+    for run in reversed(history):
+        if run["server"] != config:
+            continue
+        for result in run["results"]:
+            if result["mode"] == mode:
+                return result
+    return None
+
+
+def print_result(result, previous):
+    line = (
+        f"{result['mode']:<14} {result['wall_seconds']:8.2f}s "
+        f"{result['throughput_mb_s']:9.1f} MB/s "
+        f"{result['peak_rss_mb']:8.1f} MB RSS "
+        f"{result['cpu_seconds_per_mb'] or 0:8.4f} CPU s/MB"
+    )
+    if previous:
+        change = result["throughput_mb_s"] / previous["throughput_mb_s"] - 1
+        line += f"  ({change:+.1%} vs {previous['commit'] or 'last run'})"
+    if result["exit_code"]:
+        line += f"  [exit {result['exit_code']}]"
+    print(line)
+
+
+def main():
+    args = parse_args()
+    modes = args.modes or list(MODES.items())
+    config = {
+        "scale": args.scale,
+        "latency": args.latency,
+        "bandwidth": args.bandwidth,
+    }
+    # Only added when set, so results from before these existed still compare
+    if args.capacity:
+        config["capacity"] = args.capacity
+    if args.max_active:
+        config["max_active"] = args.max_active
+
+    server = StandInServer(
+        ("127.0.0.1", 0),
+        args.scale,
+        args.latency,
+        args.bandwidth,
+        capacity=args.capacity,
+        max_active=args.max_active,
+    ).start()
+    total = sum(file.size for file in server.files.values()) // 2
+    print(f"Stand-in server at {server.url}, about {total / MB:.0f} MB per mode")
+
+    history = load_history(args.output)
+    commit = git_commit()
+    results = []
+    try:
+        for name, arguments in modes:
+            result = run_mode(server, name, arguments, args.repeat)
+            previous = previous_result(history, config, name)
+            results.append(result)
+            print_result(result, previous)
+    finally:
+        server.shutdown()
+
+    for result in results:
+        result["commit"] = commit
+    history.append(
+        {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "server": config,
+            "results": results,
+        }
+    )
+    with open(args.output, "w") as f:
+        json.dump(history, f, indent=2)
+    print(f"Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,161 @@
 import argparse
+import contextlib
+import errno
+import functools
+import hashlib
+import heapq
+import json
+import mmap
 import os
+import queue
+import random
 import re
-import requests
 import signal
+import shutil
 import sys
-import tempfile
+import threading
+import time
 import traceback
 import urllib.parse
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    FIRST_EXCEPTION,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 TAG_REGEX = r"<[^>]+>"
+ANSI_REGEX = r"\x1b\[[0-9;]*[A-Za-z]"
 DATE_REGEX = r"\((\d{1,2})/(\d{1,2})/(\d{2,4})\)"
+CONTENT_RANGE_REGEX = r"bytes (\d+)-(\d+)/(\d+|\*)"
+SIZE_REGEX = r"(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?"
+LECTURE_REGEX = r"#(S?)(\d+)([A-Z]?)"
+LECTURE_RANGE_REGEX = r"(S?)(\d+)([A-Z]?)(?:-(S?)(\d+)([A-Z]?))?"
+REVIEW_REGEX = r"Review Lecture ([A-Z])\b"
+REVIEW_RANGE_REGEX = r"R([A-Z]?)(?:-R([A-Z]))?"
+ISO_DATE_REGEX = r"\d{4}(-\d{2}(-\d{2})?)?"
+# Playlist entries in flptapes.html are JavaScript object literals
+PLAYLIST_ENTRY_REGEX = r"\{[^{}]*\}"
+PLAYLIST_FIELD_REGEX = r"""["']?(\w+)["']?\s*:\s*(["'])((?:\\.|(?!\2).)*)\2"""
+JS_ESCAPE_REGEX = r"\\(?:u([0-9a-fA-F]{4})|(.))"
+CHARSET_REGEX = r"charset=([\w-]+)"
+RANGE_REGEX = r"bytes=(\d*)-(\d*)"
+SHARD_REGEX = r"(\d+)/(\d+)"
+# A "%" that doesn't start an escape, such as %41, in a URL
+STRAY_PERCENT_REGEX = r"%(?![0-9A-Fa-f]{2})"
+
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+CHUNK_SIZE = 64 * 1024
+MIN_CHUNK_SIZE = 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+# Response head lines must fit in an asyncio connection's buffer, whatever the
+# chunk size; http.client allows lines of this length too
+MIN_HEAD_BUFFER = 64 * 1024
+# Characters left as they are in a request's path and query, as by requests
+URL_SAFE = "!$&'()*+,/:;=@[]~"
+
+BURST_SECONDS = 0.1
+
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".part.json"
+LEASE_SUFFIX = ".lease"
+LOCK_SUFFIX = ".lock"
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+# Output extension of each format, and the playlist key of its URL
+FORMATS = {"m4a": "m4a", "ogg": "oga"}
+CONTENT_TYPES = {"m4a": "audio/mp4", "ogg": "audio/ogg"}
+
+HASH_ALGORITHM = "sha256"
+HASH_ALGORITHMS = ("sha256", "blake2b")
+MANIFEST_NAME = ".flp-manifest.json"
+MANIFEST_VERSION = 1
+
+CACHE_INDEX = "index.json"
+CACHE_VERSION = 1
+
+CATALOG_PAGE = "flptapes.html"
+CATALOG_NAME = ".flp-catalog.json"
+CATALOG_VERSION = 1
+CATALOG_FIELDS = ("title", "m4a", "oga")
+# Linux ioctl that shares the source file's extents (btrfs, XFS and others)
+FICLONE = 0x40049409
+
+# A process downloading a file holds a lease on it, renewed every third of
+# LEASE_TTL seconds; other processes look again every LEASE_POLL seconds
+LEASE_TTL = 60
+LEASE_POLL = 5.0
+LEASED = "leased"
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+RETRIES = 5
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+MAX_RETRY_AFTER = 600
+RETRY_PASSES = 1
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+OVERLOAD_STATUSES = {429, 503}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 10
+
+ENGINES = ("threads", "asyncio")
+# Things main does instead of downloading, which Downloader doesn't take
+CLI_MODES = ("list", "plan", "dry_run", "verify", "merge", "serve", "refresh_catalog")
+ORDERS = ("playlist", "largest")
+SHARD_METHODS = ("hash", "size")
+
+# Adaptive concurrency starts low and is adjusted every interval: raised by
+# one while that gains at least ADAPTIVE_GAIN in throughput, cut on signs of
+# overload, and held for ADAPTIVE_HOLD intervals after a raise gained nothing.
+# Sharing bandwidth delays first bytes a little as well, so a time to first
+# byte only counts as overload while throughput has stopped rising, and once
+# it is ADAPTIVE_TTFB_RISE times (and ADAPTIVE_TTFB_MARGIN seconds over) the
+# lowest seen
+ADAPTIVE_START = 2
+ADAPTIVE_INTERVAL = 2.0
+ADAPTIVE_GAIN = 0.05
+ADAPTIVE_TTFB_RISE = 2.0
+ADAPTIVE_TTFB_MARGIN = 0.5
+ADAPTIVE_HOLD = 5
+
+PREFLIGHT_JOBS = 8
+ASSUMED_RATE = 1024 * 1024
+
+REFRESH_INTERVAL = 0.2
+LOG_INTERVAL = 10
+RATE_SMOOTHING = 0.3
+
+EVENT_KINDS = (
+    "queued",
+    "started",
+    "progress",
+    "retrying",
+    "done",
+    "skipped",
+    "failed",
+    "concurrency",
+    "log",
+)
+MIN_MEASURED_BYTES = 1024 * 1024
+SKIP_REASONS = {
+    "exists": "already exists",
+    "complete": "already complete",
+    "unchanged": "unchanged upstream",
+    "cached": "filled from cache",
+    "claimed": "downloaded by another process",
+}
+
+CANCEL = threading.Event()
 
 BASE_URL = "https://www.feynmanlectures.caltech.edu"
-REFERER = urllib.parse.urljoin(BASE_URL, "flptapes.html")
+REFERER = urllib.parse.urljoin(BASE_URL, CATALOG_PAGE)
 
 FLP_PLAYLIST = [
     {
@@ -623,15 +766,29 @@ FLP_PLAYLIST = [
 ]
 
 
-def parse_args():
+def build_parser(exit_on_error=True):
     parser = argparse.ArgumentParser(
         description="Download Feynman Lectures on Physics audio files",
         formatter_class=argparse.RawDescriptionHelpFormatter,
+        exit_on_error=exit_on_error,
         epilog="""
 Examples:
   %(prog)s                           # Download to default 'out' directory
   %(prog)s -o downloads              # Download to 'downloads' directory
   %(prog)s --no-date                 # Don't include lecture date in filenames
+  %(prog)s --lectures 1-17,34A       # Download only the selected lectures
+  %(prog)s -j 4                      # Download 4 files at a time
+  %(prog)s --order largest -j 8      # Start the largest files first
+  %(prog)s --engine asyncio -j 200   # Download 200 files at a time with asyncio
+  %(prog)s --adaptive -j 32          # Find how many files at a time the server takes
+  %(prog)s --sync                    # Refresh files that changed upstream
+  %(prog)s --list --lectures S1-S10  # List lectures without downloading
+  %(prog)s --plan                    # Show what would be downloaded, offline
+  %(prog)s --dry-run                 # Check upstream, then show the plan
+  %(prog)s --verify                  # Check downloaded files against the manifest
+  %(prog)s --serve 8000 -j 4         # Serve lectures to the LAN, fetching on demand
+  %(prog)s --shard 2/4 -o part2      # Download the second quarter of the files
+  %(prog)s --merge part1 part2       # Combine shard directories into 'out'
 """,
     )
 
@@ -642,6 +799,13 @@ Examples:
         help="Output directory for downloaded files (default: 'out')",
     )
 
+    parser.add_argument(
+        "--base-url",
+        default=BASE_URL,
+        metavar="URL",
+        help="Server to download from, e.g. a local mirror (default: %(default)s)",
+    )
+
     parser.add_argument(
         "--no-date",
         action="store_true",
@@ -651,9 +815,41 @@ Examples:
     parser.add_argument(
         "-f",
         "--format",
-        choices=["m4a", "ogg"],
-        default="m4a",
-        help="Audio format to download (default: m4a)",
+        type=formats,
+        default=["m4a"],
+        metavar="FORMAT",
+        help="Audio format to download: m4a, ogg, or several such as m4a,ogg "
+        "or all, fetched in one run (default: m4a)",
+    )
+
+    parser.add_argument(
+        "--lectures",
+        type=lecture_selectors,
+        metavar="LIST",
+        help="Comma-separated lectures and ranges to download, e.g. 1-17,34A "
+        "or S1-S64; review lectures A-C are RA-RC, or R for all three, and are "
+        "not in numbered ranges (default: all)",
+    )
+
+    parser.add_argument(
+        "--since",
+        type=date_prefix,
+        metavar="DATE",
+        help="Only lectures given on or after DATE (YYYY, YYYY-MM or YYYY-MM-DD)",
+    )
+
+    parser.add_argument(
+        "--until",
+        type=date_prefix,
+        metavar="DATE",
+        help="Only lectures given on or before DATE (YYYY, YYYY-MM or YYYY-MM-DD)",
+    )
+
+    parser.add_argument(
+        "--match",
+        type=title_pattern,
+        metavar="REGEX",
+        help="Only lectures whose title matches REGEX (case-insensitive)",
     )
 
     parser.add_argument(
@@ -662,116 +858,4384 @@ Examples:
         help="Overwrite existing files (default: skip existing files)",
     )
 
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Re-check existing files with conditional requests and download "
+        "only those that changed upstream",
+    )
+
+    parser.add_argument(
+        "--preflight",
+        action="store_true",
+        help="Check upstream sizes with HEAD requests first, re-fetching "
+        "truncated or stale files and checking free disk space",
+    )
+
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="List the selected lectures with their dates and exit",
+    )
+
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print the plan from local files and the manifest alone, without "
+        "any network requests",
+    )
+
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Run the preflight checks and print the plan without downloading",
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Re-hash the files recorded in the manifest, in parallel, and "
+        "report any that are missing or changed, without downloading",
+    )
+
+    parser.add_argument(
+        "--hash",
+        choices=HASH_ALGORITHMS,
+        default=HASH_ALGORITHM,
+        help=f"Checksum algorithm for new downloads (default: {HASH_ALGORITHM})",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        help="Keep downloaded files in a content-addressed cache in DIR, and "
+        "fill output directories from it instead of downloading again",
+    )
+
+    parser.add_argument(
+        "--refresh-catalog",
+        action="store_true",
+        help=f"Fetch the playlist from {CATALOG_PAGE} if it changed, and use "
+        "the saved copy on later runs",
+    )
+
+    parser.add_argument(
+        "--serve",
+        type=listen_address,
+        metavar="[HOST:]PORT",
+        help="Serve the selected lectures over HTTP to other machines, which "
+        "use it as --base-url; each file is fetched from upstream once into "
+        "--output-dir and sent from there",
+    )
+
+    parser.add_argument(
+        "--shard",
+        type=shard,
+        metavar="I/N",
+        help="Download only part I of N of the selected files, so N machines "
+        "can fill separate directories to be combined with --merge",
+    )
+
+    parser.add_argument(
+        "--shard-by",
+        choices=SHARD_METHODS,
+        default="hash",
+        help="Split files between shards by a hash of their path, or into "
+        "parts of equal total size, which needs HEAD requests for every "
+        "selected file (default: hash)",
+    )
+
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        metavar="DIR",
+        help="Combine the files and manifests of shard output directories into "
+        "--output-dir, verifying every file, and exit",
+    )
+
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Discard partial downloads left by an earlier run instead of "
+        "continuing them",
+    )
+
+    parser.add_argument(
+        "--connect-timeout",
+        type=positive_float,
+        default=CONNECT_TIMEOUT,
+        metavar="SECONDS",
+        help=f"Timeout for establishing a connection (default: {CONNECT_TIMEOUT})",
+    )
+
+    parser.add_argument(
+        "--read-timeout",
+        type=positive_float,
+        default=READ_TIMEOUT,
+        metavar="SECONDS",
+        help=f"Timeout for each read from the server (default: {READ_TIMEOUT})",
+    )
+
+    parser.add_argument(
+        "--retries",
+        type=non_negative_int,
+        default=RETRIES,
+        metavar="N",
+        help=f"Retries per file for transient failures (default: {RETRIES})",
+    )
+
+    parser.add_argument(
+        "--backoff",
+        type=positive_float,
+        default=BACKOFF,
+        metavar="SECONDS",
+        help=f"Base delay for exponential backoff between retries "
+        f"(default: {BACKOFF})",
+    )
+
+    parser.add_argument(
+        "--max-backoff",
+        type=positive_float,
+        default=MAX_BACKOFF,
+        metavar="SECONDS",
+        help=f"Maximum delay between retries (default: {MAX_BACKOFF})",
+    )
+
+    parser.add_argument(
+        "--limit-rate",
+        type=rate,
+        metavar="RATE",
+        help="Limit the combined download rate, in bytes per second, e.g. 5M",
+    )
+
+    parser.add_argument(
+        "--limit-rate-per-conn",
+        type=rate,
+        metavar="RATE",
+        help="Limit the download rate of each connection, e.g. 500K",
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        type=chunk_size,
+        default=CHUNK_SIZE,
+        metavar="SIZE",
+        help="Read/write chunk size per transfer, e.g. 256K; this is also the "
+        "most file data held in memory per transfer (default: 64K, max: 16M)",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        default=1,
+        metavar="N",
+        help="Number of files to download in parallel (default: 1)",
+    )
+
+    parser.add_argument(
+        "--per-host",
+        type=positive_int,
+        metavar="N",
+        help="Maximum parallel downloads from a single host (default: same as --jobs)",
+    )
+
+    parser.add_argument(
+        "--order",
+        choices=ORDERS,
+        default="playlist",
+        help="Order to start downloads in: the playlist's, or largest first, "
+        "which finishes parallel runs sooner when sizes are known from "
+        "--preflight or the manifest (default: playlist)",
+    )
+
+    parser.add_argument(
+        "--priority",
+        type=lecture_selectors,
+        metavar="LIST",
+        help="Download these lectures before the others, in the order given, "
+        "e.g. S1-S64 or 1-17,34A,R",
+    )
+
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adjust the number of parallel downloads while running, up to "
+        "--jobs, raising it while throughput grows and lowering it when the "
+        "server shows signs of overload",
+    )
+
+    parser.add_argument(
+        "--segments",
+        type=positive_int,
+        default=1,
+        metavar="N",
+        help="Split each file into N byte ranges fetched over parallel "
+        "connections, if the server supports ranges (default: 1)",
+    )
+
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="threads",
+        help="Run downloads on a pool of threads, or as tasks on one asyncio "
+        "event loop, which scales to hundreds of --jobs (default: threads)",
+    )
+
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
 
-    return parser.parse_args()
+    return parser
 
 
-def signal_handler(signum, frame):
-    print("\nDownload interrupted. Cleaning up...")
-    sys.exit(1)
+def parse_args(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        check_options(args)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
 
 
-def clean_title(title):
-    """Remove HTML tags and date from title."""
-    return re.sub(DATE_REGEX, "", re.sub(TAG_REGEX, "", title)).strip()
+def parse_options(options, args=None):
+    """Apply keyword `options`, named after the command line's, to `args`.
 
+    Values are converted and checked as on the command line: strings or
+    numbers as the option's argument, and True or False for flags. Returns a
+    new namespace, based on the defaults if `args` is None. Raises TypeError
+    for unknown options and ValueError for invalid values.
+    """
+    parser = build_parser(exit_on_error=False)
+    defaults = parser.parse_args([])
+    argv = []
+    flags = {}
+    for name, value in options.items():
+        if name in CLI_MODES:
+            raise TypeError(f"{name} is a command-line mode, not a Downloader option")
+        if not hasattr(defaults, name):
+            raise TypeError(f"Unknown option: {name}")
+        if isinstance(getattr(defaults, name), bool):
+            if not isinstance(value, bool):
+                raise TypeError(f"Option {name} must be True or False")
+            flags[name] = value
+        elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+            argv.append(f"--{name.replace('_', '-')}={value}")
+        else:
+            raise TypeError(f"Option {name} must be a string or number")
 
-def extract_date(title):
-    """Extract and format date from title."""
-    match = re.search(DATE_REGEX, title)
+    namespace = argparse.Namespace(**vars(args or defaults))
+    try:
+        parser.parse_args(argv, namespace)
+    except argparse.ArgumentError as e:
+        raise ValueError(str(e)) from None
+    for name, value in flags.items():
+        setattr(namespace, name, value)
+    check_options(namespace)
+    return namespace
+
+
+def check_options(args):
+    """Raise ValueError if `args` combines options that don't work together."""
+    if args.engine == "asyncio" and args.segments > 1:
+        raise ValueError("--segments is not supported with --engine asyncio")
+    if args.engine == "asyncio" and args.adaptive:
+        raise ValueError("--adaptive is not supported with --engine asyncio")
+    if args.engine == "asyncio":
+        async_proxies()
+    if args.plan and args.shard and args.shard_by == "size":
+        raise ValueError(
+            "--shard-by size needs HEAD requests, which --plan doesn't make"
+        )
+
+
+def parse_size(value):
+    """Parse a size such as '64K' or '5M' into a number of bytes."""
+    match = re.fullmatch(SIZE_REGEX, value.strip(), re.IGNORECASE)
     if not match:
-        raise ValueError(f"Invalid date format in title: {title}")
+        raise ValueError(f"Invalid size: {value}")
 
-    month, day, year = match.groups()
-    if len(year) == 2:
-        year = "19" + year
-    return f"{year}-{month.zfill(2)}-{day.zfill(2)}"
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.lower()])
 
 
-def build_filename(title, no_date, format_ext):
-    """Build filename from title and options."""
-    clean = clean_title(title)
-    if not no_date:
-        date = extract_date(title)
-        return f"{date} - {clean}.{format_ext}"
-    return f"{clean}.{format_ext}"
+def rate(value):
+    """Argparse type for transfer rates in bytes per second, e.g. 5M."""
+    try:
+        size = parse_size(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
+    if size < 1:
+        raise argparse.ArgumentTypeError("rate must be at least 1 byte per second")
+    return size
 
-def download_file(url, path, referer):
-    """Download a file to a temporary location, then move to final path."""
-    temp_fd, temp_path = tempfile.mkstemp(
-        suffix=f".tmp.{os.path.splitext(path)[1][1:]}",
-        dir=os.path.dirname(path),
-        prefix="flp_download_",
-    )
 
+def throttled_chunk_size(args):
+    """Shrink the chunk size so a rate-limited connection is paced smoothly.
+
+    A connection sleeps after each chunk, so chunks are kept to about
+    BURST_SECONDS worth of its share of the rate.
+    """
+    rates = []
+    if args.limit_rate:
+        rates.append(args.limit_rate / (args.jobs * args.segments))
+    if args.limit_rate_per_conn:
+        rates.append(args.limit_rate_per_conn)
+    size = int(min(rates) * BURST_SECONDS)
+    return max(MIN_CHUNK_SIZE, min(args.chunk_size, size))
+
+
+def listen_address(value):
+    """Argparse type for an address to listen on, [HOST:]PORT."""
+    host, _, port = value.rpartition(":")
+    if not port.isdigit() or int(port) > 65535:
+        raise argparse.ArgumentTypeError(f"Invalid port: {value}")
+    return host, int(port)
+
+
+def shard(value):
+    """Argparse type for --shard I/N, returning (I, N) with I from 1 to N."""
+    match = re.fullmatch(SHARD_REGEX, value.strip())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid shard: {value} (use I/N, e.g. 2/4)")
+    index, count = map(int, match.groups())
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"Invalid shard: {value} (I is 1 to N)")
+    return index, count
+
+
+def chunk_size(value):
+    """Argparse type for --chunk-size, bounded to keep memory per transfer capped."""
     try:
-        response = requests.get(
-            url,
-            headers={"Referer": referer},
-            stream=True,
+        size = parse_size(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+    if not MIN_CHUNK_SIZE <= size <= MAX_CHUNK_SIZE:
+        raise argparse.ArgumentTypeError(
+            f"chunk size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE} bytes"
         )
-        response.raise_for_status()
+    return size
 
-        with os.fdopen(temp_fd, "wb") as temp_file:
-            temp_file.write(response.content)
 
-        os.rename(temp_path, path)
-        temp_path = None
+def positive_int(value):
+    """Argparse type for options that take a count of at least one."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid number: {value}")
 
-    finally:
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.unlink(temp_path)
-            except OSError:
-                pass
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
 
 
-def main():
-    args = parse_args()
-    signal.signal(signal.SIGINT, signal_handler)
+def non_negative_int(value):
+    """Argparse type for options that take a count of zero or more."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid number: {value}")
 
-    os.makedirs(args.output_dir, exist_ok=True)
-    if args.verbose:
-        print(f"Created directory: {args.output_dir}")
+    if number < 0:
+        raise argparse.ArgumentTypeError("must not be negative")
+    return number
 
-    for i, item in enumerate(FLP_PLAYLIST, 1):
-        title = item["title"]
-        clean = clean_title(title)
 
-        audio_key = "m4a" if args.format == "m4a" else "oga"
-        file_ext = args.format if args.format == "m4a" else "ogg"
+def positive_float(value):
+    """Argparse type for durations and other quantities above zero."""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid number: {value}")
+
+    if number <= 0:
+        raise argparse.ArgumentTypeError("must be greater than 0")
+    return number
 
-        filename = build_filename(title, args.no_date, file_ext)
-        path = os.path.join(args.output_dir, filename)
 
-        if os.path.exists(path) and not args.overwrite:
-            if args.verbose:
-                print(f"Skipping {clean} (already exists).")
+def formats(value):
+    """Argparse type for --format: one format, a comma-separated list, or "all"."""
+    if value == "all":
+        return list(FORMATS)
+
+    chosen = []
+    for name in value.lower().split(","):
+        name = name.strip()
+        if name not in FORMATS:
+            raise argparse.ArgumentTypeError(
+                f"Invalid format: {name} (choose from {', '.join(FORMATS)} or all)"
+            )
+        if name not in chosen:
+            chosen.append(name)
+    return chosen
+
+
+def lecture_selectors(value):
+    """Argparse type for --lectures.
+
+    Returns a list of (series, first, last) selectors, where series is "" for
+    the main lectures, "S" for the seminars or "R" for the review lectures
+    and first and last are (number, suffix) pairs. A range without a suffix
+    on its last lecture includes the lettered lectures that follow it, e.g.
+    1-34 includes 34A. Review lectures are numbered 0: RB is Review Lecture
+    B, RA-RB a range of them and R all of them.
+    """
+    selectors = []
+    for part in value.upper().split(","):
+        review = re.fullmatch(REVIEW_RANGE_REGEX, part.strip())
+        if review:
+            first, last = review.groups()
+            last = last or first or "~"
+            if first > last:
+                raise argparse.ArgumentTypeError(f"Invalid lecture or range: {part}")
+            selectors.append(("R", (0, first), (0, last)))
             continue
 
-        print(
-            f"\x1b[2K[{i}/{len(FLP_PLAYLIST)}] Downloading \x1b[3m{clean}\x1b[0m...",
-            end="\r",
+        match = re.fullmatch(LECTURE_RANGE_REGEX, part.strip())
+        if not match:
+            raise argparse.ArgumentTypeError(f"Invalid lecture or range: {part}")
+
+        series, first, first_suffix, last_series, last, last_suffix = match.groups()
+        if last is None:
+            lecture = (int(first), first_suffix)
+            selectors.append((series, lecture, lecture))
+            continue
+        if last_series and last_series != series:
+            raise argparse.ArgumentTypeError(f"Range mixes lecture series: {part}")
+        # "~" sorts after every letter, so the range ends after the lettered ones
+        last_lecture = (int(last), last_suffix or "~")
+        selectors.append((series, (int(first), first_suffix), last_lecture))
+    return selectors
+
+
+def date_prefix(value):
+    """Argparse type for a full or partial ISO date (YYYY[-MM[-DD]])."""
+    if not re.fullmatch(ISO_DATE_REGEX, value):
+        raise argparse.ArgumentTypeError(f"Invalid date: {value}")
+    # Complete a partial date with the first month and day, so that the
+    # month and day given are checked against the calendar
+    try:
+        time.strptime(value + "-01-01"[len(value) - 4 :], "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date: {value}")
+    return value
+
+
+def title_pattern(value):
+    """Argparse type for a case-insensitive title regex."""
+    try:
+        return re.compile(value, re.IGNORECASE)
+    except re.error as e:
+        raise argparse.ArgumentTypeError(f"Invalid regex: {e}")
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a transfer when the run has been interrupted."""
+
+
+class IncompleteDownload(IOError):
+    """Raised when a transfer ends before the advertised size was received."""
+
+
+class UpstreamChanged(IncompleteDownload):
+    """Raised when a file changes upstream while its segments are downloading."""
+
+
+class HostLimiter:
+    """Cap the number of transfers running against any single host.
+
+    Slots are threading semaphores, or instances of `semaphore` if given,
+    such as asyncio.BoundedSemaphore for the asyncio engine.
+    """
+
+    def __init__(self, limit, semaphore=threading.BoundedSemaphore):
+        self.limit = limit
+        self.semaphore = semaphore
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    def slot(self, url):
+        """Return the semaphore guarding transfers to the host of `url`."""
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = self.semaphore(self.limit)
+            return self._slots[host]
+
+
+class AdaptiveLimiter:
+    """Cap the number of transfers at a limit fitted to the server at runtime.
+
+    Takes the place of a HostLimiter, whose per-host slots in `hosts` are
+    taken as well, and is adjusted AIMD-style every ADAPTIVE_INTERVAL seconds
+    by a background thread, from the events of the run passed through emit().
+    While transfers are waiting for a slot, the limit goes up by one for as
+    long as each step raises the total throughput, and a step that gains
+    nothing is undone. It is halved when the server answers 429 or 503 or a
+    transfer times out, and cut by a quarter when the time to first byte
+    rises well above the lowest seen without throughput rising. Running
+    transfers are left to finish when it goes down. Each change is passed to
+    `emit` as a "concurrency" event, with the reason for it.
+    """
+
+    def __init__(self, maximum, hosts, emit):
+        self.maximum = maximum
+        self.hosts = hosts
+        self.limit = min(ADAPTIVE_START, maximum)
+        self.peak = self.limit
+        self.active = 0
+        self.waiting = 0
+        self._emit = emit
+        self._changed = threading.Condition()
+        self._transfers = {}
+        self._received = 0
+        self._ttfbs = []
+        self._overload = None
+        self._baseline = None
+        self._raised_from = None
+        self._cut = False
+        self._hold = 0
+        self._last_received = 0
+        self._last_rate = None
+        self._last_tick = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        """Wait until fewer than `limit` transfers are running, then run one."""
+        with self._changed:
+            self.waiting += 1
+            self._changed.wait_for(lambda: self.active < self.limit)
+            self.waiting -= 1
+            self.active += 1
+        try:
+            with self.hosts.slot(url):
+                yield
+        finally:
+            with self._changed:
+                self.active -= 1
+                self._changed.notify()
+
+    def emit(self, event):
+        """Take note of an event of the run, then pass it on."""
+        transfer = event.transfer
+        with self._changed:
+            if event.kind == "started":
+                # Maps each transfer to whether its time to first byte is known
+                self._transfers[transfer] = False
+            elif event.kind in ("done", "failed") and transfer in self._transfers:
+                self._time(transfer)
+                self._received += transfer.received
+                del self._transfers[transfer]
+            if event.kind in ("retrying", "failed") and event.error is not None:
+                self._overload = overload_reason(event.error) or self._overload
+                if transfer in self._transfers:
+                    # Its first byte will come after the backoff delay too
+                    self._transfers[transfer] = True
+        self._emit(event)
+
+    def start(self):
+        """Start adjusting the limit in a background thread and return self."""
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def adjust(self):
+        """Change the limit according to what was seen since the last call."""
+        now = time.monotonic()
+        with self._changed:
+            for transfer in self._transfers:
+                self._time(transfer)
+            received = self._received + sum(t.received for t in self._transfers)
+            ttfbs, self._ttfbs = sorted(self._ttfbs), []
+            overload, self._overload = self._overload, None
+            waiting = self.waiting
+        rate = (received - self._last_received) / max(now - self._last_tick, 1e-9)
+        rising = self._last_rate is not None and rate > self._last_rate * (
+            1 + ADAPTIVE_GAIN
         )
+        self._last_received = received
+        self._last_rate = rate
+        self._last_tick = now
+
+        if self._cut:
+            # Errors and delays right after a cut mostly come from transfers
+            # started before it, so give it an interval to take effect
+            self._cut = False
+            return
+        if overload:
+            self._lower(max(1, self.limit // 2), overload)
+            return
+
+        if ttfbs:
+            ttfb = ttfbs[len(ttfbs) // 2]
+            baseline = self._baseline
+            if (
+                baseline is not None
+                and not rising
+                and ttfb
+                > max(baseline * ADAPTIVE_TTFB_RISE, baseline + ADAPTIVE_TTFB_MARGIN)
+            ):
+                if self.limit > 1:
+                    reason = (
+                        f"time to first byte up to {ttfb * 1000:.0f} ms "
+                        f"from {baseline * 1000:.0f} ms"
+                    )
+                    self._lower(self.limit - max(1, self.limit // 4), reason)
+                    return
+                # Slower even on its own, so the server is just slower now
+                self._baseline = ttfb
+            elif baseline is None or ttfb < baseline:
+                self._baseline = ttfb
+
+        if self._hold:
+            self._hold -= 1
+        elif not waiting:
+            # Every queued transfer is running, so more slots would go unused
+            self._raised_from = None
+        elif self._raised_from is not None and rate < self._raised_from * (
+            1 + ADAPTIVE_GAIN
+        ):
+            reason = f"no gain from {self.limit} transfers at once"
+            self._lower(self.limit - 1, reason)
+            self._hold = ADAPTIVE_HOLD
+        elif self.limit < self.maximum:
+            reason = f"throughput {format_size(rate)}/s"
+            if self._raised_from:
+                gain = rate / self._raised_from - 1
+                reason = f"throughput up {gain:.0%} to {format_size(rate)}/s"
+            self._set(self.limit + 1, "Raised", reason)
+            self._raised_from = rate
+
+    def _lower(self, limit, reason):
+        self._set(limit, "Lowered", reason)
+        self._raised_from = None
+        self._cut = True
+
+    def _set(self, limit, verb, reason):
+        with self._changed:
+            self.limit = limit
+            self.peak = max(self.peak, limit)
+            self._changed.notify_all()
+        message = f"{verb} concurrency to {limit}: {reason}."
+        self._emit(Event("concurrency", message=message))
+
+    def _time(self, transfer):
+        """Record the time to first byte of `transfer`, once it is known."""
+        if not self._transfers[transfer] and transfer.responded is not None:
+            self._ttfbs.append(transfer.responded - transfer.started)
+            self._transfers[transfer] = True
+
+    def _run(self):
+        while not self._stop.wait(ADAPTIVE_INTERVAL):
+            self.adjust()
 
+
+class Leases:
+    """Leases on output files, for processes sharing an output directory.
+
+    Each process downloads only the files it holds the lease on, so several
+    runs split the work instead of all downloading every file. A lease is a
+    `<file>.lease` file, created exclusively and naming the host and PID of
+    its holder and when it expires. A background thread renews this
+    process's leases while they are held. A lease that has expired, or whose
+    holder is a process on this host that no longer exists, is stale and may
+    be broken by anyone, so a crashed run holds up others for at most `ttl`
+    seconds. Expiry is judged by wall clock, so hosts sharing a directory
+    need synchronized clocks.
+    """
+
+    def __init__(self, ttl=LEASE_TTL):
+        import socket
+
+        self.ttl = ttl
+        self.host = socket.gethostname()
+        self.token = os.urandom(8).hex()
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def claim(self, path):
+        """Take the lease on `path` and return its path, or None if it is held."""
+        lease_path = path + LEASE_SUFFIX
+        for _ in range(3):
+            try:
+                fd = os.open(lease_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                holder = read_lease(lease_path)
+                if not self._stale(lease_path, holder):
+                    return None
+                if not self._break(lease_path, holder):
+                    return None
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._record(), f)
+            with self._lock:
+                self._held.add(lease_path)
+            return lease_path
+        return None
+
+    def release(self, lease_path):
+        """Give up a lease taken by claim()."""
+        with self._lock:
+            self._held.discard(lease_path)
+        if self._owns(lease_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(lease_path)
+
+    def start(self):
+        """Start renewing held leases in a background thread and return self."""
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _record(self):
+        return {
+            "host": self.host,
+            "pid": os.getpid(),
+            "token": self.token,
+            "expires": time.time() + self.ttl,
+        }
+
+    def _owns(self, lease_path):
+        holder = read_lease(lease_path)
+        return holder is not None and holder.get("token") == self.token
+
+    def _stale(self, lease_path, holder):
+        if holder is None:
+            # Unreadable, or just created and not yet written
+            try:
+                return time.time() - os.path.getmtime(lease_path) > self.ttl
+            except FileNotFoundError:
+                return True
+        if holder.get("expires", 0) < time.time():
+            return True
+        return holder.get("host") == self.host and not pid_alive(holder.get("pid"))
+
+    def _break(self, lease_path, holder):
+        """Remove a stale lease, unless it was replaced since it was read.
+
+        Returns whether the lease may now be claimed again.
+        """
+        stale_path = f"{lease_path}.{self.token}"
         try:
-            url = urllib.parse.urljoin(BASE_URL, item[audio_key])
-            download_file(url, path, REFERER)
-            print(
-                f"\x1b[2K[{i}/{len(FLP_PLAYLIST)}] Downloaded \x1b[3m{clean}\x1b[0m.",
-                end="\r",
-            )
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return True
+        if read_lease(stale_path) != holder:
+            # Another process broke it first and claimed it; put its lease back
+            with contextlib.suppress(OSError):
+                os.link(stale_path, lease_path)
+            os.unlink(stale_path)
+            return False
+        os.unlink(stale_path)
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.ttl / 3):
+            with self._lock:
+                held = list(self._held)
+            for lease_path in held:
+                if self._owns(lease_path):
+                    write_json(lease_path, self._record())
+
+
+def read_lease(lease_path):
+    """Return the contents of a lease file, or None if it can't be read."""
+    try:
+        with open(lease_path) as f:
+            holder = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return holder if isinstance(holder, dict) else None
+
+
+def pid_alive(pid):
+    """Whether a process with this PID exists on this host."""
+    if not isinstance(pid, int) or os.name == "nt":
+        # os.kill can't probe a process on Windows, so rely on expiry there
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on `path` against other processes, if supported."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def claim_job(job, leases, manifest):
+    """Take the lease on a job's file before downloading it.
+
+    Returns the lease to release afterwards, or None if another process
+    holds it, or downloaded the file since the run was planned; then the
+    job is marked as skipped for that reason and its entry adopted.
+    """
+    lease = leases.claim(job["path"])
+    if lease is None:
+        return None
+    entry = manifest.recorded_elsewhere(job["filename"])
+    if entry is not None and os.path.exists(job["path"]):
+        leases.release(lease)
+        job["action"], job["reason"], job["known"] = "skip", "claimed", entry
+        return None
+    return lease
+
+
+class Manifest:
+    """Record of the files downloaded to an output directory, kept as JSON.
 
-        except requests.RequestException as e:
-            print(f"\x1b[2K[{i}/{len(FLP_PLAYLIST)}] Failed to download {clean}: {e}")
-            if args.verbose:
-                traceback.print_exc()
+    Each entry is keyed by filename and holds the source URL, size, ETag,
+    Last-Modified and checksum, so later runs can make conditional requests
+    instead of downloading everything again. Other processes may be
+    recording downloads to the same directory, so each save merges in what
+    they saved, under a lock file where the platform supports one.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self._recorded = {}
+        data = self._load()
+        self.files = data.get("files", {})
+        self.throughput = data.get("throughput")
+        self._loaded = dict(self.files)
+
+    def get(self, filename):
+        """Return the entry recorded for `filename`, if any."""
+        with self._lock:
+            return self.files.get(filename)
+
+    def record(self, filename, entry):
+        """Record `entry` for `filename` and save the manifest."""
+        with self._lock:
+            self.files[filename] = entry
+            self._recorded[filename] = entry
+            self._save()
+
+    def recorded_elsewhere(self, filename):
+        """Return the entry another process saved for `filename`, if any.
+
+        Only entries saved since this manifest was loaded count. The entry
+        is adopted, so get() returns it from then on.
+        """
+        with self._lock:
+            entry = self._load().get("files", {}).get(filename)
+            if (
+                entry is None
+                or entry == self._loaded.get(filename)
+                or filename in self._recorded
+            ):
+                return None
+            self.files[filename] = entry
+            return entry
+
+    def set_throughput(self, rate):
+        """Record the download rate of the last run, for time estimates."""
+        with self._lock:
+            self.throughput = rate
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        with file_lock(self.path + LOCK_SUFFIX):
+            self.files = {**self._load().get("files", {}), **self._recorded}
+            write_json(
+                self.path,
+                {
+                    "version": MANIFEST_VERSION,
+                    "throughput": self.throughput,
+                    "files": self.files,
+                },
+            )
+
+
+class Cache:
+    """Content-addressed store of downloaded files, shared between runs.
+
+    Blobs are named by checksum under `blobs/`, and an index maps each
+    upstream URL to the manifest entry (validators and checksum) of the blob
+    it last served. Output directories are filled from the store by hardlink,
+    reflink or copy, so changing the naming layout or keeping several output
+    directories needs no new transfers and, when linking works, no more disk.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, CACHE_INDEX)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.entries = self._load()
+
+    def blob_path(self, checksum):
+        """Return where the blob with `checksum` ("algorithm:hex") is stored."""
+        algorithm, _, digest = checksum.partition(":")
+        return os.path.join(self.directory, "blobs", algorithm, digest[:2], digest)
+
+    def get(self, url):
+        """Return the entry cached for `url`, if its blob is present."""
+        with self._lock:
+            entry = self.entries.get(url)
+        if not entry or not entry.get("checksum"):
+            return None
+        try:
+            if os.path.getsize(self.blob_path(entry["checksum"])) != entry["size"]:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def match(self, url, size, etag=None, last_modified=None):
+        """Return the entry cached for `url` if upstream still serves its blob.
+
+        The entry must have upstream's `size` and its `etag` or, failing that,
+        its `last_modified`; without either validator to compare, there is no
+        match.
+        """
+        entry = self.get(url)
+        if not entry or size is None or entry["size"] != size:
+            return None
+        if etag and entry.get("etag"):
+            return entry if entry["etag"] == etag else None
+        if last_modified and entry.get("last_modified"):
+            return entry if entry["last_modified"] == last_modified else None
+        return None
+
+    def add(self, path, entry):
+        """Store the file at `path`, described by manifest `entry`."""
+        blob = self.blob_path(entry["checksum"])
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            place_file(path, blob)
+        # Other processes may share the cache, so merge with their updates
+        with self._lock, file_lock(self.path + LOCK_SUFFIX):
+            self.entries = self._load()
+            self.entries[entry["url"]] = entry
+            write_json(self.path, {"version": CACHE_VERSION, "entries": self.entries})
+
+    def fill(self, entry, path):
+        """Place the blob for `entry` at `path`; returns how it was placed."""
+        return place_file(self.blob_path(entry["checksum"]), path)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f).get("entries", {})
+        except (OSError, ValueError):
+            return {}
+
+
+def reflink(source, destination):
+    """Make `destination` a copy-on-write clone of `source`, if supported."""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported here")
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def place_file(source, destination):
+    """Atomically make `destination` hold the contents of `source`.
+
+    Tries a hardlink, then a reflink, then a plain copy, and returns which
+    one worked.
+    """
+    temp_path = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        try:
+            os.link(source, temp_path)
+            method = "hardlink"
+        except OSError:
+            try:
+                reflink(source, temp_path)
+                method = "reflink"
+            except OSError:
+                shutil.copyfile(source, temp_path)
+                method = "copy"
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return method
+
+
+class TokenBucket:
+    """Token bucket limiting the combined rate of everyone consuming from it.
+
+    Consumers take tokens for each chunk after receiving it and may overdraw
+    the bucket; each then sleeps off its own share of the debt. Concurrent
+    consumers therefore queue up fairly, and the refill is computed lazily
+    under a single lock acquisition per chunk. The bucket holds at most
+    BURST_SECONDS worth of tokens, so an idle period is not followed by a
+    long burst above the rate.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate * BURST_SECONDS
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take `amount` tokens and return how long to wait for them, if at all.
+
+        Lets a caller that must not block, such as a coroutine, do the
+        waiting itself.
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return -self._tokens / self.rate
+
+    def consume(self, amount, stop=None):
+        """Take `amount` tokens, sleeping until the bucket has paid for them."""
+        delay = self.reserve(amount)
+        if delay > 0:
+            if stop is not None:
+                stop.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+class Throttle:
+    """Bandwidth limits for transfers: one shared rate, one per connection."""
+
+    def __init__(self, rate=None, connection_rate=None):
+        self.shared = TokenBucket(rate) if rate else None
+        self.connection_rate = connection_rate
+
+    @property
+    def limited(self):
+        """Whether any limit is set."""
+        return bool(self.shared or self.connection_rate)
+
+    def buckets(self):
+        """Return the token buckets that one new connection draws from."""
+        buckets = [self.shared] if self.shared else []
+        if self.connection_rate:
+            buckets.append(TokenBucket(self.connection_rate))
+        return buckets
+
+    def connection(self):
+        """Return a function pacing the chunks of one connection, or None."""
+        buckets = self.buckets()
+        if not buckets:
+            return None
+
+        def pace(amount, stop=None):
+            for bucket in buckets:
+                bucket.consume(amount, stop)
+
+        return pace
+
+
+def signal_handler(signum, frame):
+    print("\nDownload interrupted. Keeping partial downloads for the next run...")
+    CANCEL.set()
+    sys.exit(1)
+
+
+class Event:
+    """Something that happened during a Downloader run, passed to its sink.
+
+    `kind` is one of EVENT_KINDS. Events of a running download carry its
+    `transfer` and a snapshot of its `done` and `size`; "done" carries the
+    manifest `entry`, "failed" the `error`, and "retrying", "log" and
+    "concurrency" a `message`.
+    """
+
+    def __init__(
+        self, kind, job=None, transfer=None, entry=None, error=None, message=None
+    ):
+        self.kind = kind
+        self.job = job
+        self.transfer = transfer
+        self.entry = entry
+        self.error = error
+        self.message = message
+        self.done = transfer.done if transfer else 0
+        self.size = transfer.size if transfer else job and job["size"]
+
+    def __repr__(self):
+        label = self.job["filename"] if self.job else self.message
+        return f"Event({self.kind!r}, {label!r})"
+
+
+class Transfer:
+    """Byte counters for one download, updated by its worker threads.
+
+    `responded` is when the server first answered with the file's size, or
+    None until then. If `emit` is given, a "progress" event is passed to it as
+    bytes arrive, at most every REFRESH_INTERVAL seconds.
+    """
+
+    def __init__(self, job, emit=None):
+        self.job = job
+        self.size = job["size"]
+        self.done = 0
+        self.received = 0
+        self.started = time.monotonic()
+        self.responded = None
+        self._emit = emit
+        self._reported = self.started
+        self._lock = threading.Lock()
+
+    def set_size(self, size, offset=0):
+        """Record the full size of the file and how much of it is already local."""
+        with self._lock:
+            self.size = size
+            self.done = offset
+            if self.responded is None:
+                self.responded = time.monotonic()
+
+    def advance(self, amount):
+        """Count `amount` bytes just received."""
+        with self._lock:
+            self.done += amount
+            self.received += amount
+            now = time.monotonic()
+            report = self._emit and now - self._reported >= REFRESH_INTERVAL
+            if report:
+                self._reported = now
+        if report:
+            self._emit(Event("progress", self.job, self))
+
+    @property
+    def rate(self):
+        """Average bytes per second received by this transfer."""
+        elapsed = time.monotonic() - self.started
+        return self.received / elapsed if elapsed > 0 else 0.0
+
+
+class Progress:
+    """Status output for a run: per-item lines, live transfers and totals.
+
+    On a terminal, a block showing each active transfer and the aggregate
+    rate and ETA is redrawn below the status lines by a background thread,
+    at most every REFRESH_INTERVAL seconds, so rendering cost does not grow
+    with the number of chunks received. Elsewhere, such as in logs, plain
+    lines are printed instead, with a summary every LOG_INTERVAL seconds.
+
+    It is the sink of the command line's Downloader, and is called with its
+    events.
+    """
+
+    def __init__(self, args, stream=None):
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        self.single = args.jobs == 1
+        self.verbose = args.verbose
+        self.planned = 0
+        self.total = 0
+        self.expected = 0
+        self.unsized = 0
+        self.finished = 0
+        self.succeeded = 0
+        self.completed = 0
+        self.received = 0
+        self.rate = 0.0
+        self.active = []
+        self.started = time.monotonic()
+        self._drawn = 0
+        self._last_received = 0
+        self._last_tick = self.started
+        self._failed = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, event):
+        """Update the display for a Downloader event."""
+        job = event.job
+        if event.kind == "queued":
+            with self._lock:
+                if id(job) in self._failed:
+                    # Queued again for another pass after failing
+                    self._failed.discard(id(job))
+                    self.finished -= 1
+                    return
+                self.planned += 1
+                self.total += 1
+                self.expected += job["size"] or 0
+                if job["size"] is None:
+                    self.unsized += 1
+
+        elif event.kind == "skipped":
+            with self._lock:
+                if job["reason"] == "claimed":
+                    # Queued, then downloaded by another process instead
+                    self.finished += 1
+                    self.expected -= job["size"] or 0
+                    if job["size"] is None:
+                        self.unsized -= 1
+                else:
+                    self.planned += 1
+            if self.verbose:
+                self.log(f"Skipping {job['clean']} ({SKIP_REASONS[job['reason']]}).")
+
+        elif event.kind == "started":
+            with self._lock:
+                self.active.append(event.transfer)
+
+        elif event.kind == "retrying":
+            self.log(self._numbered(job, event.message))
+
+        elif event.kind == "done":
+            verb = "Downloaded" if event.entry else "Unchanged"
+            message = f"{verb} \x1b[3m{job['clean']}\x1b[0m."
+            self._finish(event.transfer, self._numbered(job, message), True)
+
+        elif event.kind == "failed":
+            if isinstance(event.error, DownloadCancelled):
+                message = f"Download of {job['clean']} interrupted."
+            else:
+                with self._lock:
+                    self._failed.add(id(job))
+                message = self._numbered(
+                    job, f"Failed to download {job['clean']}: {event.error}"
+                )
+            self._finish(event.transfer, message, failed=True)
+            if self.verbose and not isinstance(event.error, DownloadCancelled):
+                error = event.error
+                traceback.print_exception(type(error), error, error.__traceback__)
+
+        elif event.kind in ("concurrency", "log"):
+            self.log(event.message)
+
+    def _numbered(self, job, message):
+        if not self.planned:
+            # Nothing was queued up front, as when serving files on demand
+            return message
+        return f"[{job['index']}/{self.planned}] {message}"
+
+    def _finish(self, transfer, message, transient=False, failed=False):
+        """Remove a finished transfer and print its status line."""
+        with self._lock:
+            self.active.remove(transfer)
+            self.finished += 1
+            self.received += transfer.received
+            if not failed:
+                # Replace the planned size with what the file actually came to
+                self.succeeded += 1
+                self.completed += transfer.done
+                self.expected += transfer.done - (transfer.job["size"] or 0)
+                if transfer.job["size"] is None:
+                    self.unsized -= 1
+        self.log(message, transient)
+
+    def log(self, message, transient=False):
+        """Print a status line.
+
+        Transient lines are ones a single sequential download used to
+        overwrite in place; on a terminal they are left to the live view.
+        """
+        with self._lock:
+            if self.tty:
+                if transient and self.single:
+                    return
+                self._clear()
+                self.stream.write(f"\x1b[2K{message}\n")
+                self._draw()
+            else:
+                self.stream.write(re.sub(ANSI_REGEX, "", message) + "\n")
+            self.stream.flush()
+
+    def close(self):
+        """Stop redrawing and print a summary of the run."""
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            if self.tty:
+                self._clear()
+            elapsed = time.monotonic() - self.started
+            if self.succeeded:
+                rate = format_size(self.received / max(elapsed, 1e-9))
+                self.stream.write(
+                    f"Finished {self.succeeded} files in {format_duration(elapsed)}, "
+                    f"{format_size(self.received)} received ({rate}/s)\n"
+                )
+            self.stream.flush()
+
+    def _run(self):
+        interval = REFRESH_INTERVAL if self.tty else LOG_INTERVAL
+        while not self._stop.wait(interval):
+            with self._lock:
+                self._sample()
+                if self.tty:
+                    self._clear()
+                    self._draw()
+                elif self.active:
+                    self.stream.write(self._summary() + "\n")
+                self.stream.flush()
+
+    def _sample(self):
+        """Update the aggregate rate, smoothed over recent redraws."""
+        now = time.monotonic()
+        received = self.received + sum(t.received for t in self.active)
+        instant = (received - self._last_received) / max(now - self._last_tick, 1e-9)
+        self.rate = (
+            instant
+            if not self._last_received
+            else (RATE_SMOOTHING * instant + (1 - RATE_SMOOTHING) * self.rate)
+        )
+        self._last_received = received
+        self._last_tick = now
+
+    def _summary(self):
+        done = self.completed + sum(t.done for t in self.active)
+        expected = self.expected + sum(
+            t.size - (t.job["size"] or 0) for t in self.active if t.size
+        )
+
+        # Without preflight sizes, assume unseen files are of average size
+        unsized = self.unsized - sum(
+            1 for t in self.active if t.size and t.job["size"] is None
+        )
+        if unsized and expected:
+            expected += unsized * expected / max(1, self.total - unsized)
+
+        line = f"[{self.finished}/{self.total}] " if self.total else ""
+        line += format_size(done)
+        if expected:
+            line += f" of {'~' if unsized else ''}{format_size(expected)}"
+        line += f", {format_size(self.rate)}/s"
+        if expected and self.rate > 0:
+            eta = max(0, expected - done) / self.rate
+            line += f", ETA {format_duration(eta)}"
+        return line
+
+    def _draw(self):
+        if not self.active and not self.finished:
+            return
+
+        width = shutil.get_terminal_size().columns - 1
+        lines = []
+        for transfer in self.active:
+            size = f" of {format_size(transfer.size)}" if transfer.size else ""
+            percent = (
+                f"{100 * transfer.done // transfer.size:3d}% " if transfer.size else ""
+            )
+            status = (
+                f"  {percent}{format_size(transfer.done)}{size}, "
+                f"{format_size(transfer.rate)}/s"
+            )
+            label = transfer.job["clean"][: max(0, width - len(status) - 2)]
+            lines.append(f"  {label}{status}"[:width])
+        lines.append(self._summary()[:width])
+
+        self.stream.write("".join(f"\x1b[2K{line}\n" for line in lines))
+        self._drawn = len(lines)
+
+    def _clear(self):
+        if self._drawn:
+            self.stream.write(f"\x1b[{self._drawn}F\x1b[J")
+            self._drawn = 0
+
+
+@functools.lru_cache(maxsize=None)
+def clean_title(title):
+    """Remove HTML tags and date from title."""
+    return re.sub(DATE_REGEX, "", re.sub(TAG_REGEX, "", title)).strip()
+
+
+@functools.lru_cache(maxsize=None)
+def extract_date(title):
+    """Extract and format date from title."""
+    match = re.search(DATE_REGEX, title)
+    if not match:
+        raise ValueError(f"Invalid date format in title: {title}")
+
+    month, day, year = match.groups()
+    if len(year) == 2:
+        year = "19" + year
+    return f"{year}-{month.zfill(2)}-{day.zfill(2)}"
+
+
+@functools.lru_cache(maxsize=None)
+def lecture_id(title):
+    """Return the (series, number, suffix) of a lecture, e.g. ("S", 53, "A").
+
+    Review lectures are ("R", 0, letter).
+    """
+    title = re.sub(TAG_REGEX, "", title)
+    match = re.search(LECTURE_REGEX, title)
+    if not match:
+        review = re.search(REVIEW_REGEX, title)
+        return ("R", 0, review[1]) if review else None
+    series, number, suffix = match.groups()
+    return series, int(number), suffix
+
+
+def selector_index(lecture, selectors):
+    """Return the index of the first of `selectors` matching a lecture_id(), or None."""
+    if lecture is not None:
+        for i, (series, first, last) in enumerate(selectors):
+            if series == lecture[0] and first <= lecture[1:] <= last:
+                return i
+    return None
+
+
+def is_selected(item, args):
+    """Whether a playlist item passes the --lectures, date and --match filters."""
+    title = item["title"]
+    if args.lectures and selector_index(lecture_id(title), args.lectures) is None:
+        return False
+
+    if args.since or args.until:
+        date = extract_date(title)
+        if args.since and date[: len(args.since)] < args.since:
+            return False
+        if args.until and date[: len(args.until)] > args.until:
+            return False
+
+    return not args.match or args.match.search(clean_title(title))
+
+
+def build_filename(title, no_date, format_ext):
+    """Build filename from title and options."""
+    clean = clean_title(title)
+    if not no_date:
+        date = extract_date(title)
+        return f"{date} - {clean}.{format_ext}"
+    return f"{clean}.{format_ext}"
+
+
+def create_session(pool_size, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+    """Create an HTTP session shared by all transfers.
+
+    Connections are kept alive and pooled, up to `pool_size` per host, so the
+    TCP and TLS handshakes are paid once per connection rather than once per
+    file. The Referer header is sent by default on every request, and every
+    request gives up after the (connect, read) `timeout` so a stalled socket
+    cannot hang the run.
+
+    requests is imported here rather than at the top of the module, so that
+    commands which never touch the network start without loading it.
+    """
+    import requests
+
+    class TimeoutAdapter(requests.adapters.HTTPAdapter):
+        """HTTP adapter that applies a default (connect, read) timeout."""
+
+        def __init__(self, timeout, **kwargs):
+            self.timeout = timeout
+            super().__init__(**kwargs)
+
+        def send(self, request, timeout=None, **kwargs):
+            return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+    session = requests.Session()
+    adapter = TimeoutAdapter(
+        timeout,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        pool_block=True,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Referer"] = REFERER
+    # Byte offsets for resuming must refer to the stored file, not a gzip stream
+    session.headers["Accept-Encoding"] = "identity"
+    return session
+
+
+def write_json(path, data):
+    """Atomically replace `path` with `data` serialized as JSON."""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def load_partial(path, url):
+    """Return the saved state of a partial download of `url` to `path`, if any.
+
+    The offset is taken from the size of the partial file itself rather than
+    from the sidecar, since the process may have died before the sidecar was
+    last updated.
+    """
+    try:
+        with open(path + STATE_SUFFIX) as f:
+            state = json.load(f)
+        size = os.path.getsize(path + PART_SUFFIX)
+    except (OSError, ValueError):
+        return None
+
+    if "segments" not in state:
+        state["offset"] = size
+
+    if state.get("url") != url:
+        return None
+    return state
+
+
+def save_partial(path, state):
+    """Record the state of a partial download of `path` in its sidecar."""
+    write_json(path + STATE_SUFFIX, state)
+
+
+def discard_partial(path):
+    """Remove the partial file and sidecar for `path`, if present."""
+    for suffix in (PART_SUFFIX, STATE_SUFFIX):
+        try:
+            os.unlink(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def range_validator(state):
+    """Return the validator to send in If-Range for a partial, if it has one.
+
+    Weak ETags are not allowed in If-Range, so Last-Modified is used instead.
+    """
+    validator = state.get("etag")
+    if not validator or validator.startswith("W/"):
+        validator = state.get("last_modified")
+    return validator
+
+
+def resume_headers(state):
+    """Build headers that continue a partial download from its offset.
+
+    Returns None if the partial has no validator, since without one a changed
+    upstream file could be silently spliced onto stale bytes.
+    """
+    validator = range_validator(state)
+    if not validator or not state["offset"]:
+        return None
+    return {"Range": f"bytes={state['offset']}-", "If-Range": validator}
+
+
+def content_range(response):
+    """Parse the Content-Range header of a 206 response into (start, end, total)."""
+    match = re.fullmatch(CONTENT_RANGE_REGEX, response.headers.get("Content-Range", ""))
+    if not match:
+        return None
+
+    start, end, total = match.groups()
+    return int(start), int(end), None if total == "*" else int(total)
+
+
+def content_total(response):
+    """Return the full size of the resource behind `response`, if known."""
+    if response.status_code == 206:
+        parsed = content_range(response)
+        return parsed[2] if parsed else None
+
+    length = response.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+def resumed_offset(response, offset):
+    """Return `offset` if `response` continues a range request from it, else 0."""
+    if response.status_code != 206:
+        return 0
+
+    parsed = content_range(response)
+    if not parsed or parsed[0] != offset:
+        return 0
+    return offset
+
+
+def hash_file(path, limit=None, hasher=None):
+    """Hash the first `limit` bytes of `path`, or all of it by default.
+
+    Updates and returns `hasher` if given, otherwise a new HASH_ALGORITHM hash.
+    """
+    if hasher is None:
+        hasher = hashlib.new(HASH_ALGORITHM)
+
+    remaining = limit
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hasher
+
+
+def manifest_entry(path, state, hasher):
+    """Build the manifest entry for a file just downloaded to `path`."""
+    return {
+        "url": state["url"],
+        "size": os.path.getsize(path),
+        "etag": state.get("etag"),
+        "last_modified": state.get("last_modified"),
+        "checksum": f"{hasher.name}:{hasher.hexdigest()}",
+    }
+
+
+def hash_mapped(path, algorithm):
+    """Return the hex digest of all of `path`, read through a memory map.
+
+    Used by --verify in worker processes: the hash reads straight from the
+    page cache, without copying the file through Python in chunks.
+    """
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hasher.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view:
+                hasher.update(view)
+    return hasher.hexdigest()
+
+
+def plan_check(name, path, entry):
+    """Prepare to check the file at `path` against its manifest `entry`.
+
+    Returns a check for check_checksums() and None, or None and the problem
+    that makes hashing the file pointless.
+    """
+    algorithm, _, digest = (entry.get("checksum") or "").partition(":")
+    if not os.path.exists(path):
+        return None, "missing"
+    if os.path.getsize(path) != entry.get("size"):
+        return None, "size differs from manifest"
+    if algorithm not in hashlib.algorithms_available or not digest:
+        return None, "no usable checksum in manifest"
+    return (name, path, algorithm, digest), None
+
+
+def check_checksums(checks, workers):
+    """Hash files in a pool of `workers` processes and yield those that fail.
+
+    `checks` are (name, path, algorithm, hex digest) tuples. Files are
+    hashed largest first, and each (name, problem) is yielded as it is
+    found.
+    """
+    # Loads multiprocessing, which nothing else needs
+    from concurrent.futures import ProcessPoolExecutor
+
+    checks = sorted(checks, key=lambda check: os.path.getsize(check[1]), reverse=True)
+    # Workers leave Ctrl+C to the main process, which stops the pool
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=signal.signal,
+        initargs=(signal.SIGINT, signal.SIG_IGN),
+    ) as executor:
+        futures = {
+            executor.submit(hash_mapped, path, algorithm): (name, digest)
+            for name, path, algorithm, digest in checks
+        }
+        for future in as_completed(futures):
+            name, digest = futures[future]
+            try:
+                matches = future.result() == digest
+            except OSError as e:
+                yield name, str(e)
+                continue
+            if not matches:
+                yield name, "checksum mismatch"
+
+
+def verify_files(directory, manifest, workers):
+    """Check every file recorded in `manifest` against its size and checksum.
+
+    Files are hashed by a pool of `workers` processes, largest first, so the
+    whole collection is checked in parallel. Prints each problem found and a
+    summary, and returns the number of files that failed.
+    """
+    checks = []
+    problems = []
+    for filename, entry in sorted(manifest.files.items()):
+        path = os.path.join(directory, filename)
+        check, problem = plan_check(filename, path, entry)
+        if problem:
+            problems.append((filename, problem))
+        else:
+            checks.append(check)
+    for filename, problem in problems:
+        print(f"{filename}: {problem}")
+
+    total = sum(os.path.getsize(check[1]) for check in checks)
+    started = time.monotonic()
+    for filename, problem in check_checksums(checks, workers):
+        problems.append((filename, problem))
+        print(f"{filename}: {problem}")
+
+    elapsed = time.monotonic() - started
+    speed = f" ({format_size(total / elapsed)}/s)" if elapsed > 0 else ""
+    print(
+        f"Verified {len(manifest.files)} files, {format_size(total)} hashed in "
+        f"{format_duration(elapsed)}{speed}: {len(problems)} problems."
+    )
+    return len(problems)
+
+
+def merge_directories(sources, directory, filenames, workers):
+    """Combine the files of shard output directories `sources` into `directory`.
+
+    Every file recorded in a source's manifest is checked against its
+    checksum, in parallel as by verify_files, then placed in `directory` by
+    hardlink, reflink or copy and recorded in its manifest. Files that fail,
+    or clash with a different file of the same name from another source,
+    are left out, and any of `filenames` that no source has are reported.
+    Files already merged are not checked again. Prints each problem and a
+    summary, and returns the number of problems.
+    """
+    os.makedirs(directory, exist_ok=True)
+    target = Manifest(directory)
+    problems = []
+    chosen = {}
+    present = 0
+    checks = []
+    for source in sources:
+        manifest = Manifest(source)
+        if not manifest.files:
+            problems.append((source, "no files recorded in its manifest"))
+        for filename, entry in sorted(manifest.files.items()):
+            path = os.path.join(source, filename)
+            if filename in chosen:
+                if chosen[filename][1].get("checksum") != entry.get("checksum"):
+                    other = os.path.join(chosen[filename][0], filename)
+                    problems.append((path, f"differs from {other}"))
+                continue
+            chosen[filename] = (source, entry)
+
+            current = target.get(filename)
+            destination = os.path.join(directory, filename)
+            if (
+                current
+                and current.get("checksum") == entry.get("checksum")
+                and os.path.exists(destination)
+                and os.path.getsize(destination) == current.get("size")
+            ):
+                present += 1
+                continue
+            check, problem = plan_check(path, path, entry)
+            if problem:
+                problems.append((path, problem))
+            else:
+                checks.append(check)
+    for name, problem in problems:
+        print(f"{name}: {problem}")
+
+    failed = set()
+    for path, problem in check_checksums(checks, workers):
+        failed.add(path)
+        problems.append((path, problem))
+        print(f"{path}: {problem}")
+
+    methods = {}
+    for path, *_ in checks:
+        if path in failed:
+            continue
+        filename = os.path.basename(path)
+        entry = chosen[filename][1]
+        method = place_file(path, os.path.join(directory, filename))
+        target.record(filename, entry)
+        methods[method] = methods.get(method, 0) + 1
+
+    for filename in filenames:
+        # Files found but left out have been reported already
+        if filename not in chosen and target.get(filename) is None:
+            problems.append((filename, "in none of the directories"))
+            print(f"{filename}: in none of the directories")
+
+    merged = sum(methods.values())
+    breakdown = ", ".join(f"{count} by {method}" for method, count in methods.items())
+    breakdown = f" ({breakdown})" if breakdown else ""
+    print(
+        f"Merged {merged} files from {len(sources)} directories{breakdown}, "
+        f"{present} already present: {len(problems)} problems."
+    )
+    return len(problems)
+
+
+def conditional_headers(entry):
+    """Build headers that fetch a file only if it differs from `entry`."""
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def whole_file_headers(known=None):
+    """Build headers that fetch a whole file, conditional on `known` if given.
+
+    The file is asked for as the range "bytes=0-", so that a server supporting
+    ranges states its full size in Content-Range. A wrong Content-Length can
+    make a short body look complete, but not match that as well.
+    """
+    headers = {"Range": "bytes=0-"}
+    if known:
+        headers.update(conditional_headers(known))
+    return headers
+
+
+def split_ranges(size, count):
+    """Split `size` bytes into `count` [start, position, end] segments.
+
+    `end` is inclusive, as in a Range header, and `position` is the next byte
+    to fetch, so a segment is complete once `position` passes `end`.
+    """
+    step = -(-size // count)
+    return [
+        [start, start, min(start + step, size) - 1] for start in range(0, size, step)
+    ]
+
+
+def plan_segments(session, url, count):
+    """Probe `url` and return a fresh segmented state, or None if not possible.
+
+    Segmenting needs the server to advertise byte ranges, a known size and a
+    validator that keeps every segment on the same version of the file. Files
+    too small to give each segment MIN_SEGMENT_SIZE bytes are not split.
+    """
+    with session.head(url, allow_redirects=True) as response:
+        if not response.ok:
+            return None
+        headers = response.headers
+
+    size = content_total(response)
+    state = {
+        "url": url,
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "size": size,
+    }
+    if headers.get("Accept-Ranges", "").lower() != "bytes" or not size:
+        return None
+    if not range_validator(state):
+        return None
+
+    count = min(count, size // MIN_SEGMENT_SIZE)
+    if count < 2:
+        return None
+
+    state["segments"] = split_ranges(size, count)
+    return state
+
+
+def fetch_segment(
+    session,
+    url,
+    part_path,
+    segment,
+    validator,
+    chunk_size,
+    stop,
+    throttle=None,
+    transfer=None,
+):
+    """Fetch one byte range of `url` and write it at its offset in `part_path`."""
+    start, position, end = segment
+    if position > end:
+        return
+
+    pace = throttle.connection() if throttle else None
+    headers = {"Range": f"bytes={position}-{end}", "If-Range": validator}
+    with session.get(url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        parsed = content_range(response) if response.status_code == 206 else None
+        if not parsed or parsed[0] != position:
+            raise UpstreamChanged(f"{url} changed upstream during download")
+
+        with open(part_path, "r+b", buffering=0) as part_file:
+            part_file.seek(position)
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if stop.is_set():
+                    raise DownloadCancelled(url)
+                chunk = chunk[: end - segment[1] + 1]
+                if pace:
+                    pace(len(chunk), stop)
+                part_file.write(chunk)
+                segment[1] += len(chunk)
+                if transfer:
+                    transfer.advance(len(chunk))
+                if segment[1] > end:
+                    break
+
+    if segment[1] <= end:
+        raise IncompleteDownload(f"Segment {start}-{end} of {url} ended early")
+
+
+def download_segmented(
+    session, url, path, state, count, chunk_size, cancel, throttle=None, transfer=None
+):
+    """Download `url` as parallel byte ranges written into a preallocated file.
+
+    Continues the segments recorded in `state` if given, otherwise probes the
+    server and splits the file into `count` ranges. Returns the final state,
+    or None without downloading anything if the server cannot serve ranges,
+    so the caller can fall back to a single stream.
+    """
+    part_path = path + PART_SUFFIX
+    if state is None:
+        state = plan_segments(session, url, count)
+        if state is None:
+            return None
+
+        with open(part_path, "wb") as part_file:
+            part_file.truncate(state["size"])
+        save_partial(path, state)
+
+    if transfer:
+        done = sum(position - start for start, position, _ in state["segments"])
+        transfer.set_size(state["size"], done)
+
+    # One failed segment stops its siblings instead of letting them run on
+    stop = threading.Event()
+
+    validator = range_validator(state)
+    executor = ThreadPoolExecutor(max_workers=len(state["segments"]))
+    try:
+        futures = [
+            executor.submit(
+                fetch_segment,
+                session,
+                url,
+                part_path,
+                seg,
+                validator,
+                chunk_size,
+                stop,
+                throttle,
+                transfer,
+            )
+            for seg in state["segments"]
+        ]
+        pending = futures
+        while pending:
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_EXCEPTION)
+            if any(future.exception() for future in done):
+                stop.set()
+            if cancel is not None and cancel.is_set():
+                stop.set()
+
+        # Report the segment that failed first, not the siblings it stopped
+        errors = [future.exception() for future in futures if future.exception()]
+        errors.sort(key=lambda e: isinstance(e, DownloadCancelled))
+        if errors:
+            raise errors[0]
+
+    except UpstreamChanged:
+        discard_partial(path)
+        raise
+
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+        if os.path.exists(part_path):
+            save_partial(path, state)
+
+    os.rename(part_path, path)
+    discard_partial(path)
+    return state
+
+
+def request_headers(state, known=None):
+    """Build the headers of a request for a file, resuming `state` if possible."""
+    headers = resume_headers(state) if state else None
+    return whole_file_headers(known) if headers is None else headers
+
+
+def partial_rejected(response, state):
+    """Whether `response` refuses the range asked for to resume `state`.
+
+    The partial then no longer matches anything upstream can serve, and the
+    download starts over without it.
+    """
+    return response.status_code == 416 and state is not None
+
+
+def response_state(url, response, state):
+    """Return the partial state of a download whose response has arrived.
+
+    Continues from `state`'s offset if the response resumes it.
+    """
+    return {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "size": content_total(response),
+        "offset": resumed_offset(response, state["offset"]) if state else 0,
+    }
+
+
+def open_partial(path, offset):
+    """Open the partial file of `path` unbuffered, to write from `offset` on."""
+    part_file = open(path + PART_SUFFIX, "r+b" if offset else "wb", buffering=0)
+    part_file.seek(offset)
+    part_file.truncate()
+    return part_file
+
+
+def check_complete(url, state, size=None):
+    """Raise IncompleteDownload unless the whole file has been received.
+
+    A wrong Content-Length can make a short body look complete, so `size`
+    (e.g. from a HEAD request) counts too, if larger.
+    """
+    expected = state["size"]
+    if size is not None and (expected is None or expected < size):
+        expected = size
+    if expected is not None and state["offset"] != expected:
+        raise IncompleteDownload(
+            f"Received {state['offset']} of {expected} bytes for {url}"
+        )
+
+
+def download_file(
+    session,
+    url,
+    path,
+    chunk_size=CHUNK_SIZE,
+    cancel=None,
+    resume=True,
+    segments=1,
+    known=None,
+    throttle=None,
+    transfer=None,
+    size=None,
+    algorithm=HASH_ALGORITHM,
+):
+    """Stream a file to a partial file, then move it to the final path.
+
+    The partial file and a sidecar with its validator and offset stay next to
+    `path` if the transfer fails, and the next call resumes them with a Range
+    request. With `segments` above one, the file is fetched as parallel byte
+    ranges where the server allows. A body short of its Content-Range total,
+    or of `size` if given, raises IncompleteDownload.
+
+    With `known` (a manifest entry) the request is conditional, and None is
+    returned if the file is unchanged upstream. Otherwise returns the new
+    file's manifest entry, checksummed with `algorithm` as it is written.
+    """
+    part_path = path + PART_SUFFIX
+    state = load_partial(path, url) if resume else None
+    hasher = hashlib.new(algorithm)
+
+    # Segments arrive out of order, so their checksum needs a pass over the file
+    if state is not None and "segments" in state:
+        download_segmented(
+            session, url, path, state, segments, chunk_size, cancel, throttle, transfer
+        )
+        return manifest_entry(path, state, hash_file(path, hasher=hasher))
+    if segments > 1 and not known:
+        state = download_segmented(
+            session, url, path, None, segments, chunk_size, cancel, throttle, transfer
+        )
+        if state is not None:
+            return manifest_entry(path, state, hash_file(path, hasher=hasher))
+
+    response = session.get(url, headers=request_headers(state, known), stream=True)
+    if response.status_code == 304:
+        response.close()
+        return None
+    if partial_rejected(response, state):
+        response.close()
+        discard_partial(path)
+        return download_file(
+            session,
+            url,
+            path,
+            chunk_size,
+            cancel,
+            False,
+            segments,
+            known,
+            throttle,
+            transfer,
+            size,
+            algorithm,
+        )
+
+    with response:
+        response.raise_for_status()
+
+        state = response_state(url, response, state)
+        offset = state["offset"]
+        save_partial(path, state)
+        if transfer:
+            transfer.set_size(state["size"], offset)
+
+        if offset:
+            hash_file(part_path, offset, hasher)
+
+        pace = throttle.connection() if throttle else None
+        try:
+            with open_partial(path, offset) as part_file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if cancel is not None and cancel.is_set():
+                        raise DownloadCancelled(url)
+                    if pace:
+                        pace(len(chunk), cancel)
+                    part_file.write(chunk)
+                    hasher.update(chunk)
+                    state["offset"] += len(chunk)
+                    if transfer:
+                        transfer.advance(len(chunk))
+        finally:
+            save_partial(path, state)
+
+    check_complete(url, state, size)
+    os.rename(part_path, path)
+    discard_partial(path)
+    return manifest_entry(path, state, hasher)
+
+
+def is_retryable(error):
+    """Whether a failed transfer may succeed if tried again."""
+    # Errors of the asyncio engine, which runs without requests
+    if isinstance(error, HTTPStatusError):
+        return error.response.status_code in RETRY_STATUSES
+    if isinstance(error, (ConnectionError, TimeoutError, IncompleteDownload)):
+        return True
+    if isinstance(error, InvalidRequest):
+        return False
+
+    import requests
+
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and (
+            error.response.status_code in RETRY_STATUSES
+        )
+    return isinstance(
+        error,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
+
+
+def is_timeout(error):
+    """Whether a transfer failed because the server took too long."""
+    if isinstance(error, TimeoutError):
+        return True
+
+    import requests
+    from urllib3.exceptions import ReadTimeoutError
+
+    if isinstance(error, requests.Timeout):
+        return True
+    # requests reports a read timeout while streaming a body as a ConnectionError
+    return any(isinstance(arg, ReadTimeoutError) for arg in error.args)
+
+
+def overload_reason(error):
+    """Describe how `error` shows the server to be overloaded, or return None."""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status in OVERLOAD_STATUSES:
+        return f"server answered {status}"
+    if is_timeout(error):
+        return "a transfer timed out"
+    return None
+
+
+def retry_after(error):
+    """Return the delay in seconds requested by a Retry-After header, if any."""
+    response = getattr(error, "response", None)
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+
+    from email.utils import parsedate_to_datetime
+
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def backoff_delay(attempt, error, args):
+    """Return how long to wait before retry number `attempt` (from 0).
+
+    Uses capped exponential backoff with full jitter, so parallel workers
+    hitting the same failure don't retry in lockstep. A Retry-After header
+    from the server takes precedence, up to MAX_RETRY_AFTER.
+    """
+    requested = retry_after(error)
+    if requested is not None:
+        return min(requested, MAX_RETRY_AFTER)
+    return random.uniform(0, min(args.max_backoff, args.backoff * 2**attempt))
+
+
+def retry_delay(job, transfer, attempt, error, args, emit):
+    """Decide whether to retry a failed download, and after how long.
+
+    `attempt` counts the retries made so far. Emits a "retrying" event and
+    returns the delay, or emits "failed" and returns None if the error is
+    final or the job has used up its retries.
+    """
+    if attempt >= args.retries or not is_retryable(error):
+        emit(Event("failed", job, transfer, error=error))
+        return None
+    delay = backoff_delay(attempt, error, args)
+    message = (
+        f"Retrying {job['clean']} in {delay:.1f}s "
+        f"({attempt + 1}/{args.retries}): {error}"
+    )
+    emit(Event("retrying", job, transfer, error=error, message=message))
+    return delay
+
+
+def unclaimed(job, emit):
+    """Return the result of a job whose lease claim_job didn't get.
+
+    LEASED if another process holds the lease, or 0 once the job is skipped
+    because another process has downloaded the file.
+    """
+    if job["reason"] != "claimed":
+        return LEASED
+    emit(Event("skipped", job))
+    return 0
+
+
+def run_job(
+    job,
+    args,
+    session,
+    limiter,
+    manifest,
+    emit,
+    cancel,
+    throttle=None,
+    cache=None,
+    transfer=None,
+    leases=None,
+):
+    """Download a single playlist item, passing its events to `emit`.
+
+    Transient failures are retried up to --retries times with backoff; each
+    retry resumes from the partial file. Stops early if `cancel` is set.
+    Returns the number of bytes written to the output directory, or None if
+    the download failed. The new file is added to `cache`, if given.
+    `transfer` replaces the Transfer that would be created to track it.
+    With `leases`, the file is only downloaded under its lease, and LEASED
+    is returned if another process holds it.
+    """
+    import requests
+
+    with limiter.slot(job["url"]), contextlib.ExitStack() as held:
+        if cancel.is_set():
+            return 0
+        if leases:
+            lease = claim_job(job, leases, manifest)
+            if lease is None:
+                return unclaimed(job, emit)
+            held.callback(leases.release, lease)
+
+        transfer = transfer or Transfer(job, emit)
+        emit(Event("started", job, transfer))
+        attempt = 0
+        while True:
+            try:
+                entry = download_file(
+                    session,
+                    job["url"],
+                    job["path"],
+                    args.chunk_size,
+                    cancel,
+                    not args.no_resume,
+                    args.segments,
+                    job["known"],
+                    throttle,
+                    transfer,
+                    job["size"],
+                    args.hash,
+                )
+                break
+
+            except (requests.RequestException, IncompleteDownload) as e:
+                delay = retry_delay(job, transfer, attempt, e, args, emit)
+                if delay is None:
+                    return None
+                attempt += 1
+                if cancel.wait(delay):
+                    error = DownloadCancelled(job["url"])
+                    emit(Event("failed", job, transfer, error=error))
+                    return 0
+
+            except DownloadCancelled as e:
+                emit(Event("failed", job, transfer, error=e))
+                return 0
+
+        if entry is not None:
+            manifest.record(job["filename"], entry)
+            if cache:
+                store_in_cache(cache, job, entry, emit)
+        emit(Event("done", job, transfer, entry=entry))
+        return entry["size"] if entry else 0
+
+
+def run_jobs(
+    jobs,
+    args,
+    session,
+    limiter,
+    manifest,
+    emit,
+    cancel,
+    throttle=None,
+    cache=None,
+    leases=None,
+):
+    """Run `jobs` through the worker pool.
+
+    Jobs whose file another process holds the lease on are put back in the
+    queue behind the rest, and tried again every LEASE_POLL seconds until
+    that process is done with them. Returns the number of bytes downloaded
+    and the jobs that failed.
+    """
+    executor = ThreadPoolExecutor(max_workers=args.jobs)
+    received = 0
+    failed = []
+    futures = {}
+    deferred = []
+
+    def submit(job):
+        future = executor.submit(
+            run_job,
+            job,
+            args,
+            session,
+            limiter,
+            manifest,
+            emit,
+            cancel,
+            throttle,
+            cache,
+            leases=leases,
+        )
+        futures[future] = job
+
+    try:
+        for job in jobs:
+            submit(job)
+        while futures or deferred:
+            if cancel.is_set():
+                deferred = []
+            timeout = None
+            if deferred:
+                timeout = max(0.0, deferred[0][0] - time.monotonic())
+            if futures:
+                done, _ = wait(futures, timeout, FIRST_COMPLETED)
+            else:
+                done = ()
+                cancel.wait(timeout)
+
+            for future in done:
+                job = futures.pop(future)
+                result = future.result()
+                if result is LEASED:
+                    deferred.append((time.monotonic() + LEASE_POLL, job))
+                elif result is None:
+                    failed.append(job)
+                else:
+                    received += result
+            while deferred and deferred[0][0] <= time.monotonic():
+                submit(deferred.pop(0)[1])
+
+    except BaseException:
+        cancel.set()
+        raise
+
+    finally:
+        executor.shutdown(wait=True, cancel_futures=cancel.is_set())
+
+    return received, failed
+
+
+class HTTPStatusError(Exception):
+    """An error status received by AsyncHTTPClient."""
+
+    def __init__(self, response):
+        super().__init__(
+            f"{response.status_code} {response.reason} for url: {response.url}"
+        )
+        self.response = response
+
+
+class InvalidRequest(ValueError):
+    """Raised by AsyncHTTPClient for a URL or header it can't send."""
+
+
+@functools.lru_cache(maxsize=None)
+def connection_protocol():
+    """Return the asyncio protocol class of AsyncHTTPClient connections.
+
+    Defined on first use, so that only the asyncio engine imports asyncio.
+    """
+    import asyncio
+
+    class Connection(asyncio.BufferedProtocol):
+        """One HTTP connection, received straight into a fixed buffer.
+
+        The transport reads into `buffer` itself and is paused while it is
+        full, so a connection holds at most `size` bytes however slowly they
+        are consumed, and the consumer is woken once per chunk rather than
+        once per read from the socket. A read gives up with TimeoutError
+        after `timeout` seconds without data.
+        """
+
+        def __init__(self, size, timeout):
+            self.buffer = bytearray(size)
+            self.view = memoryview(self.buffer)
+            self.timeout = timeout
+            self.start = 0
+            self.end = 0
+            self.eof = False
+            self.transport = None
+            self._paused = False
+            self._wanted = 0
+            self._waiter = None
+            self._received = time.monotonic()
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def get_buffer(self, sizehint):
+            return self.view[self.end :]
+
+        def buffer_updated(self, nbytes):
+            self.end += nbytes
+            self._received = time.monotonic()
+            if self.end == len(self.buffer):
+                self.transport.pause_reading()
+                self._paused = True
+            if self.end - self.start >= self._wanted or self._paused:
+                self._wake()
+
+        def eof_received(self):
+            self.eof = True
+            self._wake()
+
+        def connection_lost(self, exc):
+            self.eof = True
+            self._wake()
+
+        def _wake(self):
+            if self._waiter is not None and not self._waiter.done():
+                self._waiter.set_result(None)
+
+        async def _wait(self, wanted):
+            """Wait until `wanted` bytes are buffered or the connection ends."""
+            wanted = min(wanted, len(self.buffer))
+            if self.start + wanted > len(self.buffer):
+                # Move the unread bytes to the front to make room
+                count = self.end - self.start
+                self.buffer[:count] = self.buffer[self.start : self.end]
+                self.start, self.end = 0, count
+            if self._paused and self.end < len(self.buffer):
+                self.transport.resume_reading()
+                self._paused = False
+
+            started = time.monotonic()
+            while self.end - self.start < wanted and not self.eof:
+                quiet = time.monotonic() - max(started, self._received)
+                if quiet >= self.timeout:
+                    raise TimeoutError(f"Read timed out after {self.timeout}s")
+                self._wanted = wanted
+                self._waiter = asyncio.get_running_loop().create_future()
+                try:
+                    await asyncio.wait_for(self._waiter, self.timeout - quiet)
+                except asyncio.TimeoutError:
+                    # Data may have arrived since, short of what is wanted
+                    pass
+                finally:
+                    self._waiter = None
+
+        async def read(self, size):
+            """Return up to `size` bytes, fewer only at the end of the connection.
+
+            The result is a view of the buffer, valid until the next read.
+            """
+            await self._wait(size)
+            size = min(size, self.end - self.start)
+            chunk = self.view[self.start : self.start + size]
+            self.start += size
+            return chunk
+
+        async def readline(self):
+            """Return the next line as bytes, or what is left at the end."""
+            while True:
+                index = self.buffer.find(b"\n", self.start, self.end)
+                if index >= 0 or self.eof:
+                    end = index + 1 if index >= 0 else self.end
+                    line = bytes(self.view[self.start : end])
+                    self.start = end
+                    return line
+                if self.end - self.start == len(self.buffer):
+                    raise ConnectionError("Line too long in HTTP response")
+                await self._wait(self.end - self.start + 1)
+
+        @property
+        def idle(self):
+            """Whether the connection may be reused for another request."""
+            return not self.eof and self.start == self.end
+
+        def close(self):
+            self.transport.close()
+
+    return Connection
+
+
+class AsyncResponse:
+    """Response of an AsyncHTTPClient request, shaped like a requests response.
+
+    Has the `status_code`, `reason`, `headers` and `url` read by the helpers
+    shared with the threaded engine. The body is read with iter_content(),
+    and close() hands the connection back to the client for reuse if the
+    body was read to its end.
+    """
+
+    def __init__(self, client, key, url, status_line, headers, connection, head):
+        version, status, reason = status_line
+        self.url = url
+        self.status_code = status
+        self.reason = reason
+        self.headers = headers
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._keep_alive = (
+            version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+        )
+        self._chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+        length = headers.get("Content-Length")
+        if head or status in (204, 304) or status < 200:
+            self._length = 0
+        elif self._chunked or length is None or not length.strip().isdigit():
+            self._length = None
+        else:
+            self._length = int(length)
+        self._complete = self._length == 0
+
+    def raise_for_status(self):
+        """Raise HTTPStatusError for a 4xx or 5xx status."""
+        if self.status_code >= 400:
+            raise HTTPStatusError(self)
+
+    async def iter_content(self, chunk_size):
+        """Yield the body in chunks of up to `chunk_size` bytes.
+
+        Chunks are views of the connection's buffer, each valid until the
+        next one is requested. Raises ConnectionError if the connection
+        closes before the end of a body whose length is known.
+        """
+        if self._chunked:
+            async for chunk in self._iter_chunked(chunk_size):
+                yield chunk
+            return
+
+        remaining = self._length
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = await self._connection.read(size)
+            if not chunk:
+                if remaining is not None:
+                    raise ConnectionError(
+                        f"Connection closed {remaining} bytes before the end "
+                        f"of the body from {self.url}"
+                    )
+                # The body was delimited by the end of the connection
+                self._keep_alive = False
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+        self._complete = True
+
+    async def _iter_chunked(self, chunk_size):
+        """Yield the body of a chunked response, re-chunked to `chunk_size`."""
+        connection = self._connection
+        while True:
+            line = await connection.readline()
+            try:
+                size = int(line.split(b";")[0], 16)
+            except ValueError:
+                raise ConnectionError(f"Malformed chunked body from {self.url}")
+            if size == 0:
+                break
+            while size:
+                chunk = await connection.read(min(chunk_size, size))
+                if not chunk:
+                    raise ConnectionError(
+                        f"Connection closed mid-chunk from {self.url}"
+                    )
+                size -= len(chunk)
+                yield chunk
+            await connection.readline()
+
+        # Skip any trailer fields, up to the blank line ending the body
+        while (await connection.readline()).strip():
+            pass
+        self._complete = True
+
+    def close(self):
+        """Release the connection, keeping it alive if the body was read."""
+        if self._connection is None:
+            return
+        if self._complete and self._keep_alive and self._connection.idle:
+            self._client.release(self._key, self._connection)
+        else:
+            self._connection.close()
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncHTTPClient:
+    """Minimal HTTP/1.1 client on asyncio protocols, for the asyncio engine.
+
+    Sends the same default headers as create_session, and keeps connections
+    whose responses were read to the end for reuse, per host, so handshakes
+    are paid once per connection rather than once per file. Each connection
+    buffers `buffer_size` bytes, or MIN_HEAD_BUFFER if more. Like requests,
+    it goes through the proxies set in the environment (HTTP_PROXY,
+    HTTPS_PROXY, ALL_PROXY and NO_PROXY). URLs are percent-encoded as by
+    requests, and InvalidRequest is raised for one that can't be sent.
+    Connecting and every read give up after the (connect, read) `timeout`,
+    raising TimeoutError; other network failures raise ConnectionError.
+    """
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), buffer_size=CHUNK_SIZE):
+        self.connect_timeout, self.read_timeout = timeout
+        self.buffer_size = max(buffer_size, MIN_HEAD_BUFFER)
+        self._idle = {}
+        self._ssl = None
+        self._proxies = async_proxies()
+
+    async def get(self, url, headers=None):
+        return await self.request("GET", url, headers)
+
+    async def request(self, method, url, headers=None, redirects=MAX_REDIRECTS):
+        """Send a request and read the response head, following redirects."""
+        import http.client
+        import io
+
+        try:
+            parts = urllib.parse.urlsplit(url)
+            host = parts.hostname and parts.hostname.encode("idna").decode("ascii")
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+        except (ValueError, UnicodeError):
+            raise InvalidRequest(f"Invalid URL: {url}") from None
+        if parts.scheme not in ("http", "https") or not host:
+            raise InvalidRequest(f"Unsupported URL: {url}")
+        key = (parts.scheme, host, port)
+        authority = f"[{host}]" if ":" in host else host
+        if parts.port is not None:
+            authority += f":{parts.port}"
+        proxy = self.proxy(parts.scheme, host)
+        # Plain HTTP goes to the proxy with the whole URL; HTTPS is tunnelled
+        forwarded = proxy is not None and parts.scheme == "http"
+        target = quote_url_part(parts.path or "/")
+        if parts.query:
+            target += "?" + quote_url_part(parts.query, "?")
+        if forwarded:
+            target = f"{parts.scheme}://{authority}{target}"
+
+        lines = [
+            f"{method} {target} HTTP/1.1",
+            f"Host: {authority}",
+            f"Referer: {REFERER}",
+            # Byte offsets for resuming must refer to the stored file
+            "Accept-Encoding: identity",
+        ]
+        if forwarded and proxy.username:
+            lines.append(proxy_authorization(proxy))
+        for name, value in (headers or {}).items():
+            if re.search(r"[\r\n]", f"{name}{value}"):
+                raise InvalidRequest(f"Invalid header for {url}: {name}")
+            lines.append(f"{name}: {value}")
+        try:
+            message = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        except UnicodeEncodeError as e:
+            raise InvalidRequest(f"Can't send headers for {url}: {e}") from None
+
+        while True:
+            connection, reused = await self._connect(key, proxy)
+            try:
+                connection.transport.write(message)
+                status_line = await connection.readline()
+                version, _, rest = status_line.decode("latin-1").strip().partition(" ")
+                status, _, reason = rest.partition(" ")
+                if not version.startswith("HTTP/") or not re.fullmatch(
+                    "[0-9]{3}", status
+                ):
+                    raise ConnectionError(
+                        f"Malformed response from {parts.netloc}: {status_line!r}"
+                    )
+                head = []
+                while True:
+                    line = await connection.readline()
+                    if not line:
+                        raise ConnectionError(
+                            f"Connection closed in the response head from "
+                            f"{parts.netloc}"
+                        )
+                    if not line.strip():
+                        break
+                    head.append(line)
+
+            except TimeoutError:
+                connection.close()
+                raise
+            except OSError:
+                connection.close()
+                # The server may have closed a kept-alive connection meanwhile
+                if reused:
+                    continue
+                raise
+            break
+
+        try:
+            fields = http.client.parse_headers(io.BytesIO(b"".join(head) + b"\r\n"))
+        except http.client.HTTPException as e:
+            connection.close()
+            raise ConnectionError(f"Malformed response from {parts.netloc}: {e}")
+        response = AsyncResponse(
+            self,
+            key,
+            url,
+            (version, int(status), reason.strip()),
+            fields,
+            connection,
+            method == "HEAD",
+        )
+        location = response.headers.get("Location")
+        if response.status_code in REDIRECT_STATUSES and location:
+            response.close()
+            if not redirects:
+                raise HTTPStatusError(response)
+            url = urllib.parse.urljoin(url, location)
+            return await self.request(method, url, headers, redirects - 1)
+        return response
+
+    def proxy(self, scheme, host):
+        """Return the split URL of the proxy to reach `host` through, or None."""
+        import urllib.request
+
+        proxy = self._proxies.get(scheme) or self._proxies.get("all")
+        if not proxy or urllib.request.proxy_bypass(host):
+            return None
+        return proxy
+
+    async def _connect(self, key, proxy=None):
+        """Return an idle connection to `key`, or open a new one.
+
+        Also returns whether the connection was reused. With a `proxy`, the
+        connection is made to it, and HTTPS is tunnelled through it.
+        """
+        import asyncio
+
+        idle = self._idle.get(key)
+        while idle:
+            connection = idle.pop()
+            if connection.idle:
+                return connection, True
+            connection.close()
+
+        scheme, host, port = key
+        if scheme == "https" and self._ssl is None:
+            import ssl
+
+            self._ssl = ssl.create_default_context()
+        address = (proxy.hostname, proxy.port or 80) if proxy else (host, port)
+        protocol = connection_protocol()
+
+        async def open_connection():
+            _, connection = await asyncio.get_running_loop().create_connection(
+                lambda: protocol(self.buffer_size, self.read_timeout),
+                *address,
+                ssl=self._ssl if scheme == "https" and not proxy else None,
+            )
+            if scheme == "https" and proxy:
+                try:
+                    await self._tunnel(connection, host, port, proxy)
+                except BaseException:
+                    connection.close()
+                    raise
+            return connection
+
+        try:
+            connection = await asyncio.wait_for(open_connection(), self.connect_timeout)
+        except (asyncio.TimeoutError, TimeoutError):
+            raise TimeoutError(
+                f"Connecting to {host}:{port} timed out after "
+                f"{self.connect_timeout}s"
+            ) from None
+        except OSError as e:
+            raise ConnectionError(f"Failed to connect to {host}:{port}: {e}") from e
+        return connection, False
+
+    async def _tunnel(self, connection, host, port, proxy):
+        """Open a tunnel to host:port through `proxy`, and start TLS in it."""
+        import asyncio
+
+        lines = [f"CONNECT {host}:{port} HTTP/1.1", f"Host: {host}:{port}"]
+        if proxy.username:
+            lines.append(proxy_authorization(proxy))
+        connection.transport.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        status_line = await connection.readline()
+        while (await connection.readline()).strip():
+            pass
+        status = status_line.split()
+        if len(status) < 2 or status[1] != b"200":
+            raise ConnectionError(
+                f"Proxy {proxy.hostname} refused a tunnel: {status_line!r}"
+            )
+        connection.transport = await asyncio.get_running_loop().start_tls(
+            connection.transport, connection, self._ssl, server_hostname=host
+        )
+
+    def release(self, key, connection):
+        """Keep a connection whose response has been read, for the next request."""
+        self._idle.setdefault(key, []).append(connection)
+
+    def close(self):
+        """Close all idle connections."""
+        for connections in self._idle.values():
+            for connection in connections:
+                connection.close()
+        self._idle.clear()
+
+
+def async_proxies():
+    """Return the proxies set in the environment, split, by URL scheme.
+
+    Read as requests reads them. Raises ValueError for a proxy the asyncio
+    engine can't use: it talks to proxies over plain HTTP only.
+    """
+    import urllib.request
+
+    proxies = {}
+    for scheme, proxy in urllib.request.getproxies().items():
+        if scheme not in ("http", "https", "all"):
+            continue
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        parts = urllib.parse.urlsplit(proxy)
+        if parts.scheme != "http" or not parts.hostname:
+            raise ValueError(f"--engine asyncio doesn't support the proxy {proxy}")
+        proxies[scheme] = parts
+    return proxies
+
+
+def quote_url_part(text, safe=""):
+    """Percent-encode the path or query of a URL for a request line.
+
+    As requests does, characters in URL_SAFE and `safe` are left as they are,
+    and so are escapes already made, unless a "%" in `text` starts none.
+    """
+    if not re.search(STRAY_PERCENT_REGEX, text):
+        safe += "%"
+    return urllib.parse.quote(text, safe=URL_SAFE + safe)
+
+
+def proxy_authorization(proxy):
+    """Return the Proxy-Authorization header line for a proxy URL's credentials."""
+    import base64
+
+    credentials = ":".join(
+        urllib.parse.unquote(part or "") for part in (proxy.username, proxy.password)
+    )
+    return "Proxy-Authorization: Basic " + base64.b64encode(
+        credentials.encode("latin-1")
+    ).decode("ascii")
+
+
+async def download_file_async(
+    client,
+    url,
+    path,
+    chunk_size=CHUNK_SIZE,
+    cancel=None,
+    resume=True,
+    known=None,
+    throttle=None,
+    transfer=None,
+    size=None,
+    algorithm=HASH_ALGORITHM,
+):
+    """Stream a file to a partial file on the event loop, then rename it.
+
+    The asyncio engine's counterpart of download_file, taking an
+    AsyncHTTPClient instead of a session and fetching every file as a single
+    stream. It keeps the same partial file and sidecar, resume, conditional
+    request and checksum behaviour, and the same final rename. The socket is
+    read on the event loop, while writing, hashing and renaming run on the
+    loop's default executor, so a slow disk doesn't hold up other transfers.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    def offload(function, *args):
+        return loop.run_in_executor(None, function, *args)
+
+    part_path = path + PART_SUFFIX
+    state = await offload(load_partial, path, url) if resume else None
+    if state is not None and "segments" in state:
+        # Left by the threaded engine's --segments, whose ranges aren't resumable here
+        await offload(discard_partial, path)
+        state = None
+
+    response = await client.get(url, request_headers(state, known))
+    if response.status_code == 304:
+        response.close()
+        return None
+    if partial_rejected(response, state):
+        response.close()
+        await offload(discard_partial, path)
+        return await download_file_async(
+            client,
+            url,
+            path,
+            chunk_size,
+            cancel,
+            False,
+            known,
+            throttle,
+            transfer,
+            size,
+            algorithm,
+        )
+
+    with response:
+        response.raise_for_status()
+
+        state = response_state(url, response, state)
+        offset = state["offset"]
+        await offload(save_partial, path, state)
+        if transfer:
+            transfer.set_size(state["size"], offset)
+
+        hasher = hashlib.new(algorithm)
+        if offset:
+            await offload(hash_file, part_path, offset, hasher)
+
+        def write(chunk):
+            part_file.write(chunk)
+            hasher.update(chunk)
+
+        buckets = throttle.buckets() if throttle else []
+        part_file = await offload(open_partial, path, offset)
+        try:
+            async for chunk in response.iter_content(chunk_size):
+                if cancel is not None and cancel.is_set():
+                    raise DownloadCancelled(url)
+                for bucket in buckets:
+                    delay = bucket.reserve(len(chunk))
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await offload(write, chunk)
+                state["offset"] += len(chunk)
+                if transfer:
+                    transfer.advance(len(chunk))
+        finally:
+            # Not offloaded, so the offset is saved even if the task is cancelled
+            part_file.close()
+            save_partial(path, state)
+
+    check_complete(url, state, size)
+    await offload(os.rename, part_path, path)
+    await offload(discard_partial, path)
+    return manifest_entry(path, state, hasher)
+
+
+async def wait_cancelled(cancel, delay):
+    """Sleep on the event loop for `delay` seconds, or until `cancel` is set.
+
+    Like threading.Event.wait, returns whether `cancel` is set.
+    """
+    import asyncio
+
+    deadline = time.monotonic() + delay
+    while not cancel.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(remaining, REFRESH_INTERVAL))
+    return True
+
+
+async def run_job_async(
+    job,
+    args,
+    client,
+    limiter,
+    manifest,
+    emit,
+    cancel,
+    throttle=None,
+    cache=None,
+    leases=None,
+):
+    """Download a single playlist item on the event loop, like run_job."""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    async with limiter.slot(job["url"]), contextlib.AsyncExitStack() as held:
+        if cancel.is_set():
+            return 0
+        if leases:
+            # Lease files and the manifest are read from disk
+            lease = await loop.run_in_executor(None, claim_job, job, leases, manifest)
+            if lease is None:
+                return unclaimed(job, emit)
+            held.push_async_callback(loop.run_in_executor, None, leases.release, lease)
+
+        transfer = Transfer(job, emit)
+        emit(Event("started", job, transfer))
+        attempt = 0
+        while True:
+            try:
+                entry = await download_file_async(
+                    client,
+                    job["url"],
+                    job["path"],
+                    args.chunk_size,
+                    cancel,
+                    not args.no_resume,
+                    job["known"],
+                    throttle,
+                    transfer,
+                    job["size"],
+                    args.hash,
+                )
+                break
+
+            except (
+                ConnectionError,
+                TimeoutError,
+                HTTPStatusError,
+                IncompleteDownload,
+                InvalidRequest,
+            ) as e:
+                delay = retry_delay(job, transfer, attempt, e, args, emit)
+                if delay is None:
+                    return None
+                attempt += 1
+                if await wait_cancelled(cancel, delay):
+                    error = DownloadCancelled(job["url"])
+                    emit(Event("failed", job, transfer, error=error))
+                    return 0
+
+            except DownloadCancelled as e:
+                emit(Event("failed", job, transfer, error=e))
+                return 0
+
+        if entry is not None:
+            # Saving the manifest locks and rewrites it, and caching may copy
+            await loop.run_in_executor(None, manifest.record, job["filename"], entry)
+            if cache:
+                # Errors are reported from the executor, so back on the loop
+                report = functools.partial(loop.call_soon_threadsafe, emit)
+                await loop.run_in_executor(
+                    None, store_in_cache, cache, job, entry, report
+                )
+        emit(Event("done", job, transfer, entry=entry))
+        return entry["size"] if entry else 0
+
+
+async def run_jobs_async(
+    jobs, args, client, manifest, emit, cancel, throttle=None, cache=None, leases=None
+):
+    """Run `jobs` as tasks on the event loop, at most --jobs at a time.
+
+    Each waiting job costs a coroutine rather than a thread, so --jobs can be
+    in the hundreds. Jobs whose file another process holds the lease on
+    give up their slot and are tried again every LEASE_POLL seconds, as with
+    run_jobs. Returns the number of bytes downloaded and the jobs that failed.
+    """
+    import asyncio
+
+    slots = asyncio.Semaphore(args.jobs)
+    limiter = HostLimiter(args.per_host or args.jobs, asyncio.BoundedSemaphore)
+
+    async def run(job):
+        while True:
+            async with slots:
+                result = await run_job_async(
+                    job,
+                    args,
+                    client,
+                    limiter,
+                    manifest,
+                    emit,
+                    cancel,
+                    throttle,
+                    cache,
+                    leases,
+                )
+            if result is not LEASED:
+                return result
+            if await wait_cancelled(cancel, LEASE_POLL):
+                return 0
+
+    tasks = [asyncio.ensure_future(run(job)) for job in jobs]
+    received = 0
+    failed = []
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        cancel.set()
+        for task in tasks:
+            task.cancel()
+        raise
+
+    for job, result in zip(jobs, results):
+        if result is None:
+            failed.append(job)
+        else:
+            received += result
+    return received, failed
+
+
+def catalog_path(args):
+    """Return where the playlist catalog is kept: the cache, or the output dir."""
+    if args.cache_dir:
+        return os.path.join(args.cache_dir, CATALOG_NAME)
+    return os.path.join(args.output_dir, CATALOG_NAME)
+
+
+def load_catalog(path):
+    """Return the catalog saved at `path`, or None if there is none."""
+    try:
+        with open(path) as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if catalog.get("version") != CATALOG_VERSION or not catalog.get("playlist"):
+        return None
+    return catalog
+
+
+def unescape_js(value):
+    """Undo backslash escapes in a JavaScript string literal."""
+    return re.sub(
+        JS_ESCAPE_REGEX,
+        lambda match: chr(int(match[1], 16)) if match[1] else match[2],
+        value,
+    )
+
+
+def catalog_problem(item, filenames):
+    """Return why playlist `item` can't be used, or None if it can.
+
+    Paths must be relative to the site, so files are only ever fetched from
+    there, and the title must make filenames that are new to `filenames` and
+    stay in the output directory. Those filenames are added to it.
+    """
+    if not re.search(DATE_REGEX, item["title"]):
+        return "no date in title"
+    for key in ("m4a", "oga"):
+        parts = urllib.parse.urlsplit(item[key])
+        if parts.scheme or parts.netloc:
+            return f"{key} path is not on the site: {item[key]}"
+
+    names = [
+        build_filename(item["title"], no_date, file_ext)
+        for no_date in (False, True)
+        for file_ext in FORMATS
+    ]
+    if any(separator in name for name in names for separator in "/\\\0"):
+        return "title contains a path separator"
+    duplicate = next((name for name in names if name in filenames), None)
+    if duplicate:
+        return f"duplicate filename: {duplicate}"
+    filenames.update(names)
+    return None
+
+
+def parse_catalog(page, log=print):
+    """Extract the playlist entries from the HTML of flptapes.html.
+
+    Entries are the object literals with a title and m4a and oga paths.
+    Ones that fail catalog_problem() are left out and reported to `log`.
+    """
+    playlist = []
+    filenames = set()
+    for block in re.findall(PLAYLIST_ENTRY_REGEX, page):
+        fields = {
+            key: unescape_js(value)
+            for key, _, value in re.findall(PLAYLIST_FIELD_REGEX, block, re.DOTALL)
+        }
+        if not all(fields.get(key) for key in CATALOG_FIELDS):
+            continue
+        item = {key: fields[key] for key in CATALOG_FIELDS}
+        problem = catalog_problem(item, filenames)
+        if problem:
+            log(f"Skipping catalog entry {clean_title(item['title'])!r}: {problem}")
+            continue
+        playlist.append(item)
+    return playlist
+
+
+def refresh_catalog(args, path):
+    """Fetch the catalog page if it changed since the copy saved at `path`.
+
+    The request is conditional on the saved copy's ETag and Last-Modified,
+    so an unchanged page is neither downloaded nor parsed again. On failure
+    the saved copy (or the built-in playlist) is left in use.
+    """
+    import requests
+
+    url = urllib.parse.urljoin(args.base_url, CATALOG_PAGE)
+    saved = load_catalog(path)
+    headers = conditional_headers(saved) if saved and saved["url"] == url else None
+
+    session = create_session(1, (args.connect_timeout, args.read_timeout))
+    try:
+        with session.get(url, headers=headers) as response:
+            if response.status_code == 304:
+                print(f"Catalog is up to date ({len(saved['playlist'])} lectures).")
+                return
+            response.raise_for_status()
+            charset = re.search(CHARSET_REGEX, response.headers.get("Content-Type", ""))
+            page = response.content.decode(
+                charset[1] if charset else "utf-8", errors="replace"
+            )
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    except requests.RequestException as e:
+        print(f"Could not refresh the catalog: {e}")
+        return
+    finally:
+        session.close()
+
+    playlist = parse_catalog(page)
+    if not playlist:
+        print(f"No lectures found in {url}; keeping the current catalog.")
+        return
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    write_json(
+        path,
+        {
+            "version": CATALOG_VERSION,
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "playlist": playlist,
+        },
+    )
+    known = {item["m4a"] for item in saved["playlist"]} if saved else set()
+    added = sum(1 for item in playlist if item["m4a"] not in known)
+    change = f", {added} new" if saved else ""
+    print(f"Catalog updated: {len(playlist)} lectures{change}.")
+
+
+def plan_jobs(args, manifest, items):
+    """Resolve playlist `items` into jobs, deciding from local state what to fetch.
+
+    Each job is a dict whose `action` is "download", "sync" (conditional
+    download) or "skip", with the `reason` for it. An existing file whose size
+    differs from its manifest entry is treated as truncated and fetched again.
+
+    With several formats, each item's formats are queued next to each other,
+    so both share the worker pool and connections throughout the run.
+    """
+    targets = [(item, file_ext) for item in items for file_ext in args.format]
+
+    jobs = []
+    for i, (item, file_ext) in enumerate(targets, 1):
+        title = item["title"]
+        clean = clean_title(title)
+        if len(args.format) > 1:
+            clean = f"{clean} ({file_ext})"
+        filename = build_filename(title, args.no_date, file_ext)
+        path = os.path.join(args.output_dir, filename)
+        job = {
+            "index": i,
+            "lecture": lecture_id(title),
+            "clean": clean,
+            "filename": filename,
+            "path": path,
+            "source": item[FORMATS[file_ext]],
+            "url": urllib.parse.urljoin(args.base_url, item[FORMATS[file_ext]]),
+            "action": "download",
+            "reason": "missing",
+            "known": None,
+            "local_size": None,
+            "size": None,
+        }
+        jobs.append(job)
+
+        if not os.path.exists(path):
+            continue
+        if args.overwrite:
+            job["reason"] = "overwrite"
+            continue
+
+        entry = manifest.get(filename)
+        job["local_size"] = os.path.getsize(path)
+        if entry and entry.get("size") != job["local_size"]:
+            job["reason"] = "truncated"
+        elif args.sync:
+            from email.utils import formatdate
+
+            job["action"], job["reason"] = "sync", "sync"
+            job["known"] = entry or {
+                "last_modified": formatdate(os.path.getmtime(path), usegmt=True)
+            }
+        else:
+            job["action"], job["reason"] = "skip", "exists"
+            job["known"] = entry
+
+    return jobs
+
+
+def shard_jobs(jobs, shard, method="hash"):
+    """Return the jobs in part `index` of `count` of `jobs`, for --shard.
+
+    The split depends only on each job's playlist path (and with "size",
+    its size), so every machine given the same selection gets the same
+    parts, whatever its base URL, output directory or local state. "hash"
+    assigns each file by a hash of its path; "size" fills the parts largest
+    file first, each into the part with the least data so far, which needs
+    the size of every file.
+    """
+    index, count = shard
+    if method == "hash":
+        return [
+            job
+            for job in jobs
+            if int(hashlib.sha256(job["source"].encode()).hexdigest(), 16) % count
+            == index - 1
+        ]
+
+    unknown = sum(1 for job in jobs if job["size"] is None)
+    if unknown:
+        raise ValueError(f"Can't shard by size: {unknown} file sizes are unknown")
+    parts = [(0, part) for part in range(count)]
+    chosen = set()
+    for job in sorted(jobs, key=lambda job: (-job["size"], job["source"])):
+        total, part = heapq.heappop(parts)
+        if part == index - 1:
+            chosen.add(id(job))
+        heapq.heappush(parts, (total + job["size"], part))
+    return [job for job in jobs if id(job) in chosen]
+
+
+def plan_cache(jobs, cache, overwrite=False):
+    """Mark jobs whose file can be filled from `cache` instead of downloaded.
+
+    An entry is only used if it matches the upstream size and validators from
+    preflight (see Cache.match), so jobs without them are downloaded. With
+    `overwrite`, nothing is taken from the cache.
+    """
+    if overwrite:
+        return
+    for job in jobs:
+        if job["action"] != "download":
+            continue
+        entry = cache.match(
+            job["url"], job["size"], job.get("etag"), job.get("last_modified")
+        )
+        if entry:
+            job["action"], job["reason"], job["known"] = "skip", "cached", entry
+
+
+def expected_sizes(jobs):
+    """Return the expected size of each job's file, for scheduling.
+
+    Sizes come from preflight or the manifest; files of unknown size are
+    taken to be of the average known size (0 if none is known).
+    """
+    sizes = [job["size"] or (job["known"] or {}).get("size") for job in jobs]
+    known = [size for size in sizes if size is not None]
+    average = sum(known) / len(known) if known else 0
+    return [average if size is None else size for size in sizes]
+
+
+def order_jobs(jobs, args):
+    """Return `jobs` in the order to start them.
+
+    Jobs for lectures in --priority come first, in the order of the
+    selectors they match, and within each of those tiers and the rest,
+    --order largest starts the largest files first. With several workers,
+    that keeps a large file started near the end from running on its own
+    after the others have finished. The order is otherwise the playlist's.
+    """
+    priority = args.priority or []
+    largest = args.order == "largest"
+
+    def key(pair):
+        job, size = pair
+        tier = selector_index(job["lecture"], priority)
+        return (len(priority) if tier is None else tier, -size if largest else 0)
+
+    pairs = sorted(zip(jobs, expected_sizes(jobs)), key=key)
+    return [job for job, _ in pairs]
+
+
+def estimate_makespan(sizes, workers, rate):
+    """Estimate the seconds to download files of `sizes` started in that order.
+
+    Simulates `workers` transfers at a time sharing `rate` bytes per second
+    equally, each file starting as soon as a worker is free.
+    """
+    finish = [0.0] * max(1, min(workers, len(sizes)))
+    share = rate / workers
+    for size in sizes:
+        heapq.heapreplace(finish, finish[0] + size / share)
+    return max(finish)
+
+
+def fill_from_cache(jobs, cache, manifest, log=print):
+    """Place the files of jobs planned as "cached" in the output directory.
+
+    Jobs whose blob can't be placed are switched back to downloads. Files
+    already present with a checksum in `manifest` are added to the cache, so
+    an output directory made before the cache existed can seed it. Returns
+    how many files were placed by each method. Problems are passed to `log`.
+    """
+    methods = {}
+    for job in jobs:
+        if job["action"] != "skip":
+            continue
+        if job["reason"] != "cached":
+            entry = manifest.get(job["filename"])
+            if entry and entry.get("checksum") and not cache.get(job["url"]):
+                try:
+                    cache.add(job["path"], entry)
+                except OSError as e:
+                    log(f"Could not cache {job['clean']}: {e}")
+            continue
+
+        try:
+            method = cache.fill(job["known"], job["path"])
+        except OSError as e:
+            log(f"Could not fill {job['clean']} from cache: {e}")
+            job["action"], job["reason"], job["known"] = "download", "missing", None
+            continue
+        manifest.record(job["filename"], job["known"])
+        methods[method] = methods.get(method, 0) + 1
+    return methods
+
+
+def store_in_cache(cache, job, entry, emit):
+    """Add a finished download to `cache`, reporting rather than raising errors."""
+    try:
+        cache.add(job["path"], entry)
+    except OSError as e:
+        emit(Event("log", message=f"Could not cache {job['clean']}: {e}"))
+
+
+def head_job(session, job):
+    """Record the upstream size and validators of a job's file from a HEAD request."""
+    import requests
+
+    try:
+        with session.head(job["url"], allow_redirects=True) as response:
+            response.raise_for_status()
+            job["size"] = content_total(response)
+            job["etag"] = response.headers.get("ETag")
+            job["last_modified"] = response.headers.get("Last-Modified")
+    except requests.RequestException as e:
+        job["error"] = str(e)
+
+
+def assess_job(job):
+    """Decide from preflight results whether an existing file must be fetched.
+
+    A local file smaller than upstream is truncated; one of a different size
+    or ETag is stale. A sync job whose ETag still matches needs no request.
+    """
+    if job["local_size"] is None or job["size"] is None:
+        return
+    if job["action"] == "download":
+        return
+
+    known = job["known"] or {}
+    etag = job.get("etag")
+    etag_changed = known.get("etag") and etag and known["etag"] != etag
+    if job["local_size"] < job["size"]:
+        job["action"], job["reason"], job["known"] = "download", "truncated", None
+    elif job["local_size"] != job["size"] or etag_changed:
+        job["action"], job["reason"], job["known"] = "download", "stale", None
+    elif job["action"] == "sync" and known.get("etag"):
+        job["action"], job["reason"] = "skip", "unchanged"
+    elif job["action"] == "skip":
+        job["reason"] = "complete"
+
+
+def preflight(session, jobs, workers):
+    """Send concurrent HEAD requests for `jobs` and assess their local files."""
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for future in [executor.submit(head_job, session, job) for job in jobs]:
+            future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    for job in jobs:
+        assess_job(job)
+
+
+def format_size(size):
+    """Format a number of bytes for display, e.g. 1.5 MiB."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            break
+        size /= 1024
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+def format_duration(seconds):
+    """Format a number of seconds for display, e.g. 5m 20s."""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class Downloader:
+    """Download lectures from Python code, reporting progress as events.
+
+    Options are a parsed `args` namespace or keyword arguments named after
+    the command line's, checked by parse_options(). Each Event is passed to
+    `sink` from the thread it happens on; events() yields them instead.
+
+        downloader = Downloader(output_dir="out", jobs=4, lectures="1-17")
+        for event in downloader.events():
+            if event.kind == "done":
+                print(event.job["path"])
+    """
+
+    def __init__(self, args=None, sink=None, cancel=None, **options):
+        if options or args is None:
+            args = parse_options(options, args)
+        self.args = args
+
+        self.sink = sink
+        self.cancelled = cancel or threading.Event()
+        self.catalog = None
+        self.items = None
+        self.manifest = None
+        self.cache = None
+        self.jobs = None
+        self.estimate = None
+        self.received = 0
+        self._session = None
+
+    def emit(self, event):
+        """Pass `event` to the sink, if there is one."""
+        if self.sink:
+            self.sink(event)
+
+    def log(self, message):
+        self.emit(Event("log", message=message))
+
+    def cancel(self):
+        """Stop the run as soon as possible, keeping partial downloads."""
+        self.cancelled.set()
+
+    def select(self):
+        """Return the playlist items chosen by the selection options.
+
+        Uses the saved catalog if there is one, and touches nothing else.
+        """
+        if self.items is None:
+            self.catalog = load_catalog(catalog_path(self.args))
+            playlist = self.catalog["playlist"] if self.catalog else FLP_PLAYLIST
+            self.items = [item for item in playlist if is_selected(item, self.args)]
+        return self.items
+
+    def plan(self):
+        """Decide what to fetch for each selected item, and return the jobs.
+
+        Runs the preflight checks first if the options ask for them, or
+        else for the files the cache holds, to check them upstream. With
+        --shard, only the shard's jobs are returned, numbered from 1; raises
+        ValueError if they can't be split by size.
+        """
+        args = self.args
+        items = self.select()
+        os.makedirs(args.output_dir, exist_ok=True)
+        self.manifest = Manifest(args.output_dir)
+        self.jobs = plan_jobs(args, self.manifest, items)
+        if args.cache_dir:
+            self.cache = Cache(args.cache_dir)
+        checked = False
+        if args.shard:
+            if args.shard_by == "size":
+                # Every shard needs the sizes of all files to make the same split
+                preflight(self.session(), self.jobs, self.pool_size)
+                checked = True
+            self.jobs = shard_jobs(self.jobs, args.shard, args.shard_by)
+            for i, job in enumerate(self.jobs, 1):
+                job["index"] = i
+        if (args.preflight or args.dry_run) and not checked:
+            preflight(self.session(), self.jobs, self.pool_size)
+            checked = True
+        if self.cache and not checked and not args.overwrite:
+            # Only files the cache holds need checking upstream before use
+            cached = [
+                job
+                for job in self.jobs
+                if job["action"] == "download" and self.cache.get(job["url"])
+            ]
+            if cached:
+                preflight(self.session(), cached, self.pool_size)
+        if self.cache:
+            plan_cache(self.jobs, self.cache, args.overwrite)
+        return self.jobs
+
+    @property
+    def pool_size(self):
+        return max(self.args.jobs * self.args.segments, PREFLIGHT_JOBS)
+
+    def session(self):
+        """Return the HTTP session, creating it (and loading requests) if needed."""
+        if self._session is None:
+            timeout = (self.args.connect_timeout, self.args.read_timeout)
+            self._session = create_session(self.pool_size, timeout)
+        return self._session
+
+    def run(self):
+        """Download everything planned, planning first if needed.
+
+        Returns the jobs that failed. With the asyncio engine, the downloads
+        run on a new event loop in the calling thread.
+        """
+        args = self.args
+        if args.engine == "asyncio":
+            import asyncio
+
+            return asyncio.run(self.run_async())
+        if self.jobs is None:
+            self.plan()
+
+        limiter = HostLimiter(args.per_host or args.jobs)
+        emit = self.emit
+        if args.adaptive:
+            limiter = AdaptiveLimiter(args.jobs, limiter, self.emit)
+            emit = limiter.emit
+        leases = Leases().start()
+        try:
+            pending = self._queue()
+            throttle, args = self._throttle()
+            if args.adaptive:
+                limiter.start()
+            started = time.monotonic()
+            received = 0
+
+            # Jobs that fail even after their own retries go to the back of
+            # the run, by which time a transient outage may have passed
+            for retry_pass in range(RETRY_PASSES + 1):
+                if not pending or self.cancelled.is_set():
+                    break
+                if retry_pass:
+                    self._requeue(pending)
+                count, pending = run_jobs(
+                    pending,
+                    args,
+                    self.session(),
+                    limiter,
+                    self.manifest,
+                    emit,
+                    self.cancelled,
+                    throttle,
+                    self.cache,
+                    leases,
+                )
+                received += count
+
+        finally:
+            leases.stop()
+            if args.adaptive:
+                limiter.stop()
+            self.close()
+
+        if args.adaptive:
+            self.log(
+                f"Concurrency ended at {limiter.limit} (peak {limiter.peak}, "
+                f"limit {args.jobs})."
+            )
+        self._finish(received, time.monotonic() - started)
+        return pending
+
+    async def run_async(self):
+        """Download everything planned as tasks on the running event loop.
+
+        This is the asyncio engine, whatever the engine option says; sink
+        events are emitted on the loop's thread. Planning and filling from
+        the cache touch the disk (and preflight uses requests), so they run
+        on the loop's default executor. Returns the jobs that failed.
+        """
+        import asyncio
+
+        args = self.args
+        if args.segments > 1:
+            raise ValueError("segments are not supported by the asyncio engine")
+        if args.adaptive:
+            raise ValueError("adaptive is not supported by the asyncio engine")
+        loop = asyncio.get_running_loop()
+        if self.jobs is None:
+            await loop.run_in_executor(None, self.plan)
+
+        throttle, args = self._throttle()
+        timeout = (args.connect_timeout, args.read_timeout)
+        client = AsyncHTTPClient(timeout, args.chunk_size)
+        leases = Leases().start()
+        try:
+            pending = await loop.run_in_executor(None, self._queue)
+            started = time.monotonic()
+            received = 0
+
+            for retry_pass in range(RETRY_PASSES + 1):
+                if not pending or self.cancelled.is_set():
+                    break
+                if retry_pass:
+                    self._requeue(pending)
+                count, pending = await run_jobs_async(
+                    pending,
+                    args,
+                    client,
+                    self.manifest,
+                    self.emit,
+                    self.cancelled,
+                    throttle,
+                    self.cache,
+                    leases,
+                )
+                received += count
+
+        finally:
+            leases.stop()
+            client.close()
+            self.close()
+
+        self._finish(received, time.monotonic() - started)
+        return pending
+
+    def fill_cached(self):
+        """Place the planned files that the cache holds in the output directory."""
+        if not self.cache:
+            return
+        methods = fill_from_cache(self.jobs, self.cache, self.manifest, self.log)
+        if methods:
+            breakdown = ", ".join(
+                f"{count} by {method}" for method, count in methods.items()
+            )
+            count = sum(methods.values())
+            self.log(f"Filled {count} files from cache ({breakdown}).")
+
+    def _queue(self):
+        """Fill what the cache can, and return the jobs left to download.
+
+        They are returned in the order to start them, and their makespan is
+        estimated if any of their sizes are known.
+        """
+        self.fill_cached()
+        pending = []
+        for job in self.jobs:
+            if job["action"] == "skip":
+                self.emit(Event("skipped", job))
+            else:
+                pending.append(job)
+                self.emit(Event("queued", job))
+        pending = order_jobs(pending, self.args)
+        self.estimate = self._estimate(pending)
+        return pending
+
+    def _estimate(self, jobs):
+        """Estimate and report how long downloading `jobs` in order should take."""
+        sizes = expected_sizes(jobs)
+        if not any(sizes):
+            return None
+        args = self.args
+        workers = min(args.jobs, args.per_host or args.jobs)
+        rate = self.manifest.throughput or ASSUMED_RATE
+        estimate = estimate_makespan(sizes, workers, rate)
+        message = (
+            f"Estimated makespan {format_duration(estimate)} for {len(jobs)} "
+            f"files, {workers} at a time"
+        )
+        if args.order != "playlist" or args.priority:
+            in_playlist = sorted(jobs, key=lambda job: job["index"])
+            baseline = estimate_makespan(expected_sizes(in_playlist), workers, rate)
+            message += f" ({format_duration(baseline)} in playlist order)"
+        self.log(message + ".")
+        return estimate
+
+    def _requeue(self, jobs):
+        for job in jobs:
+            self.emit(Event("queued", job))
+        self.log(f"Retrying {len(jobs)} failed downloads...")
+
+    def _throttle(self):
+        """Return the run's Throttle, and the options to download with.
+
+        A limited rate shrinks the chunk size, on a copy of the options so
+        the namespace the Downloader was given is left as it was.
+        """
+        args = self.args
+        throttle = Throttle(args.limit_rate, args.limit_rate_per_conn)
+        if throttle.limited:
+            args = argparse.Namespace(**vars(args))
+            args.chunk_size = throttled_chunk_size(args)
+        return throttle, args
+
+    def _finish(self, received, elapsed):
+        """Record the run's throughput for the next estimate."""
+        if received >= MIN_MEASURED_BYTES and elapsed > 0:
+            self.manifest.set_throughput(received / elapsed)
+        self.received = received
+        claimed = sum(1 for job in self.jobs if job["reason"] == "claimed")
+        if claimed:
+            self.log(f"{claimed} files were downloaded by other processes.")
+        if self.estimate is not None and not self.cancelled.is_set():
+            self.log(
+                f"Makespan {format_duration(elapsed)}, estimated "
+                f"{format_duration(self.estimate)}."
+            )
+
+    def events(self):
+        """Run the download in a background thread, yielding its events.
+
+        The generator returns the failed jobs when the run ends, and closing
+        it early cancels the run.
+        """
+        events = queue.Queue()
+        finished = object()
+        outcome = {}
+
+        def work():
+            try:
+                outcome["failed"] = self.run()
+            except BaseException as e:
+                outcome["error"] = e
+            finally:
+                events.put(finished)
+
+        sink, self.sink = self.sink, events.put
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        try:
+            while True:
+                event = events.get()
+                if event is finished:
+                    break
+                yield event
+        finally:
+            if thread.is_alive():
+                self.cancel()
+                thread.join()
+            self.sink = sink
+
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["failed"]
+
+    def close(self):
+        """Close the HTTP session, if one was opened."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+class Fill(Transfer):
+    """A download that proxy clients are served from while it is written.
+
+    Clients read the partial file up to `done` as it grows, waiting on
+    `changed` for more. `ready` is set once upstream has answered, with the
+    `validators` of its file, and `finished` when the download has ended,
+    whether or not it succeeded. `generation` goes up if the download has to
+    start over, which cuts off the clients reading the earlier attempt.
+    """
+
+    def __init__(self, job, emit=None):
+        super().__init__(job, emit)
+        self.changed = threading.Condition()
+        self.ready = False
+        self.validators = {}
+        self.generation = 0
+        self.finished = False
+
+    def set_size(self, size, offset=0):
+        # download_file has just saved the validators in the sidecar
+        state = load_partial(self.job["path"], self.job["url"]) or {}
+        with self.changed:
+            if offset < self.done:
+                self.generation += 1
+            super().set_size(size, offset)
+            self.validators = state
+            self.ready = True
+            self.changed.notify_all()
+
+    def advance(self, amount):
+        super().advance(amount)
+        with self.changed:
+            self.changed.notify_all()
+
+    def finish(self):
+        with self.changed:
+            self.finished = True
+            self.changed.notify_all()
+
+
+def requested_range(header, size):
+    """Parse a Range header into the (start, end) bytes to send of `size`.
+
+    Only single ranges are honoured; anything else asks for the whole file,
+    (0, size). Returns None if the range can't be satisfied.
+    """
+    match = re.fullmatch(RANGE_REGEX, header.strip()) if header else None
+    if not match or match.groups() == ("", ""):
+        return 0, size
+
+    first, last = match.groups()
+    if not first:
+        start, end = max(0, size - int(last)), size
+        if not int(last):
+            return None
+    else:
+        start = int(first)
+        end = min(size, int(last) + 1) if last else size
+        if last and int(last) < start:
+            return 0, size
+    if start >= size:
+        return None
+    return start, end
+
+
+class Proxy:
+    """Read-through cache serving the playlist's files to other machines.
+
+    Requests use the upstream paths, so clients only need --base-url set to
+    the proxy. A file already in the output directory is sent straight from
+    disk with sendfile, honouring Range. A missing one is downloaded once,
+    through run_job with the downloader's session, retries, manifest and
+    cache, while every client asking for it meanwhile is sent the partial
+    file as it grows.
+    """
+
+    def __init__(self, downloader):
+        self.downloader = downloader
+        downloader.fill_cached()
+        args = downloader.args
+        base = urllib.parse.urljoin(args.base_url, ".")
+        self.routes = {}
+        for job in downloader.jobs:
+            if job["url"].startswith(base):
+                route = "/" + job["url"][len(base) :]
+            else:
+                route = urllib.parse.urlsplit(job["url"]).path
+            self.routes[route] = job
+
+        self.session = downloader.session()
+        self.limiter = HostLimiter(args.per_host or args.jobs)
+        self.throttle, self.args = downloader._throttle()
+        self._fills = {}
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def handle(self, request, head=False):
+        """Answer a GET (or HEAD) request of an http.server handler."""
+        job = self.routes.get(urllib.parse.urlsplit(request.path).path)
+        if job is None:
+            request.send_error(404)
+            return
+
+        with self._lock:
+            fill = self._fills.get(job["url"])
+            if fill is None and not head and not self._complete(job):
+                fill = self._start(job)
+        try:
+            if fill is not None:
+                self._send_fill(request, fill, head)
+            elif self._complete(job):
+                self._send_file(request, job, head)
+            else:
+                self._send_upstream_head(request, job)
+        except ConnectionError:
+            # The client went away
+            request.close_connection = True
+
+    def _complete(self, job):
+        """Whether the output directory holds the whole file for `job`."""
+        try:
+            size = os.path.getsize(job["path"])
+        except OSError:
+            return False
+        entry = self.downloader.manifest.get(job["filename"])
+        return not entry or entry.get("size") == size
+
+    def _start(self, job):
+        fill = Fill(job, self.downloader.emit)
+        self._fills[job["url"]] = fill
+        thread = threading.Thread(target=self._download, args=(job, fill))
+        self._threads.append(thread)
+        thread.start()
+        return fill
+
+    def _download(self, job, fill):
+        downloader = self.downloader
+        try:
+            run_job(
+                dict(job, known=None),
+                self.args,
+                self.session,
+                self.limiter,
+                downloader.manifest,
+                downloader.emit,
+                downloader.cancelled,
+                self.throttle,
+                downloader.cache,
+                fill,
+            )
+        finally:
+            with self._lock:
+                del self._fills[job["url"]]
+                self._threads.remove(threading.current_thread())
+            fill.finish()
+
+    def _send_file(self, request, job, head):
+        with open(job["path"], "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            entry = self.downloader.manifest.get(job["filename"])
+            validators = entry if entry and entry.get("size") == size else {}
+            span = self._send_head(request, job, size, validators)
+            if span and not head:
+                start, end = span
+                request.connection.sendfile(f, start, end - start)
+
+    def _send_fill(self, request, fill, head):
+        with fill.changed:
+            fill.changed.wait_for(lambda: fill.ready or fill.finished)
+            generation = fill.generation
+        if not fill.ready:
+            request.send_error(502, "Upstream download failed")
+            return
+
+        job = fill.job
+        if fill.size is None:
+            # Upstream sent no length, so neither can we
+            request.close_connection = True
+        span = self._send_head(request, job, fill.size, fill.validators)
+        if not span or head:
+            return
+
+        position, end = span
+        part = None
+        try:
+            while end is None or position < end:
+                with fill.changed:
+                    fill.changed.wait_for(
+                        lambda: fill.done > position
+                        or fill.finished
+                        or fill.generation != generation
+                    )
+                    available = fill.done
+                if fill.generation != generation or available <= position:
+                    break
+                if part is None:
+                    part = open_fill(job)
+                count = (available if end is None else min(available, end)) - position
+                position += request.connection.sendfile(part, position, count)
+        finally:
+            if part:
+                part.close()
+        if end is None or position < end:
+            # Cut short: closing tells the client the body is incomplete
+            request.close_connection = True
+
+    def _send_upstream_head(self, request, job):
+        """Answer a HEAD request for a file not fetched yet by asking upstream."""
+        probe = dict(job)
+        head_job(self.session, probe)
+        if "error" in probe:
+            request.send_error(502, "Upstream request failed")
+            return
+        self._send_head(request, job, probe["size"], {"etag": probe["etag"]})
+
+    def _send_head(self, request, job, size, validators):
+        """Send the status and headers for `job`'s file of `size` bytes.
+
+        Handles conditional and range requests. Returns the (start, end)
+        bytes to send after them, or None if there is no body.
+        """
+        etag = validators.get("etag")
+        last_modified = validators.get("last_modified")
+        headers = request.headers
+        if (etag and headers.get("If-None-Match") == etag) or (
+            last_modified and headers.get("If-Modified-Since") == last_modified
+        ):
+            request.send_response(304)
+            self._send_validators(request, etag, last_modified)
+            request.end_headers()
+            return None
+
+        span = (0, size)
+        if size is not None:
+            condition = headers.get("If-Range")
+            if not condition or condition in (etag, last_modified):
+                span = requested_range(headers.get("Range"), size)
+            if span is None:
+                request.send_response(416)
+                request.send_header("Content-Range", f"bytes */{size}")
+                request.send_header("Content-Length", "0")
+                request.end_headers()
+                return None
+
+        start, end = span
+        if size is not None and (start, end) != (0, size):
+            request.send_response(206)
+            request.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        else:
+            request.send_response(200)
+        file_ext = os.path.splitext(job["filename"])[1][1:]
+        request.send_header("Content-Type", CONTENT_TYPES.get(file_ext, "audio/mpeg"))
+        if size is not None:
+            request.send_header("Content-Length", str(end - start))
+            request.send_header("Accept-Ranges", "bytes")
+        self._send_validators(request, etag, last_modified)
+        request.end_headers()
+        return start, end
+
+    def _send_validators(self, request, etag, last_modified):
+        if etag:
+            request.send_header("ETag", etag)
+        if last_modified:
+            request.send_header("Last-Modified", last_modified)
+
+    def close(self):
+        """Wait for downloads in progress to stop, keeping their partials."""
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join()
+
+
+def open_fill(job):
+    """Open the file a Fill is writing, which may have been renamed by now."""
+    try:
+        return open(job["path"] + PART_SUFFIX, "rb")
+    except FileNotFoundError:
+        return open(job["path"], "rb")
+
+
+def serve(downloader, address):
+    """Serve the downloader's planned jobs at (host, port) until interrupted.
+
+    http.server is imported here, so that only serving loads it.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    proxy = Proxy(downloader)
+
+    class ProxyHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            proxy.handle(self)
+
+        def do_HEAD(self):
+            proxy.handle(self, head=True)
+
+        def log_message(self, format, *args):
+            if downloader.args.verbose:
+                downloader.log(f"{self.address_string()} - {format % args}")
+
+    class ProxyServer(ThreadingHTTPServer):
+        daemon_threads = True
+        # Clients may open a connection per download, all at once
+        request_queue_size = 1024
+
+    server = ProxyServer(address, ProxyHandler)
+    host, port = server.server_address[:2]
+    downloader.log(
+        f"Serving {len(proxy.routes)} files from {downloader.args.output_dir} at "
+        f"http://{host}:{port}/ (use it as --base-url)"
+    )
+    try:
+        server.serve_forever()
+    finally:
+        downloader.cancel()
+        server.server_close()
+        proxy.close()
+        downloader.close()
+
+
+def print_catalog(items):
+    """Print the date and title of each playlist item."""
+    for item in items:
+        print(f"{extract_date(item['title'])}  {clean_title(item['title'])}")
+
+
+def print_plan(jobs, args, manifest, detailed):
+    """Print what a run would fetch and how long it should take.
+
+    Returns the number of bytes still to be downloaded, not counting data
+    already in partial files or files of unknown size.
+    """
+    pending = [job for job in jobs if job["action"] != "skip"]
+    needed = 0
+    unknown = 0
+    for job in pending:
+        if job["size"] is None:
+            unknown += 1
+            continue
+        needed += job["size"]
+        part_path = job["path"] + PART_SUFFIX
+        if os.path.exists(part_path) and job["action"] == "download":
+            needed -= min(os.path.getsize(part_path), job["size"])
+
+    if detailed:
+        for job in jobs:
+            size = "?" if job["size"] is None else format_size(job["size"])
+            detail = job.get("error") or job["reason"]
+            print(f"  {job['action']:<8} {size:>10}  {job['clean']} ({detail})")
+
+    reasons = {}
+    for job in pending:
+        reasons[job["reason"]] = reasons.get(job["reason"], 0) + 1
+    breakdown = ", ".join(f"{count} {reason}" for reason, count in reasons.items())
+    breakdown = f" ({breakdown})" if breakdown else ""
+    print(f"{len(pending)} of {len(jobs)} files to fetch{breakdown}")
+
+    unknown_note = f" (+{unknown} files of unknown size)" if unknown else ""
+    print(f"Download size: {format_size(needed)}{unknown_note}")
+    print(f"Free space: {format_size(shutil.disk_usage(args.output_dir).free)}")
+
+    rate = manifest.throughput or ASSUMED_RATE
+    basis = "measured on last run" if manifest.throughput else "assumed"
+    print(
+        f"Estimated time: {format_duration(needed / rate)} "
+        f"at {format_size(rate)}/s ({basis})"
+    )
+    return needed
+
+
+def main():
+    args = parse_args()
+    signal.signal(signal.SIGINT, signal_handler)
+
+    if args.refresh_catalog:
+        refresh_catalog(args, catalog_path(args))
+    downloader = Downloader(args, cancel=CANCEL)
+
+    # Resolved up front, so a partial sync only touches the files it selects
+    items = downloader.select()
+    if args.verbose and downloader.catalog:
+        print(f"Using catalog {catalog_path(args)} ({len(items)} lectures selected).")
+    if not items:
+        print("No lectures match the selection.")
+        sys.exit(1)
+    if args.list:
+        print_catalog(items)
+        return
+
+    if args.verify:
+        manifest = Manifest(args.output_dir)
+        if verify_files(args.output_dir, manifest, os.cpu_count() or 1):
+            sys.exit(1)
+        return
+
+    if args.merge:
+        filenames = [
+            build_filename(item["title"], args.no_date, file_ext)
+            for item in items
+            for file_ext in args.format
+        ]
+        workers = os.cpu_count() or 1
+        if merge_directories(args.merge, args.output_dir, filenames, workers):
+            sys.exit(1)
+        return
+
+    try:
+        jobs = downloader.plan()
+    except ValueError as e:
+        downloader.close()
+        print(e)
+        sys.exit(1)
+    if args.verbose:
+        print(f"Created directory: {args.output_dir}")
+
+    if args.plan or args.preflight or args.dry_run:
+        detailed = args.plan or args.dry_run or args.verbose
+        needed = print_plan(jobs, args, downloader.manifest, detailed)
+        if args.plan or args.dry_run:
+            downloader.close()
+            return
+
+        free = shutil.disk_usage(args.output_dir).free
+        if needed > free:
+            downloader.close()
+            print(
+                f"Not enough free space in {args.output_dir}: need "
+                f"{format_size(needed)}, have {format_size(free)}."
+            )
+            sys.exit(1)
+
+    progress = Progress(args)
+    downloader.sink = progress
+    try:
+        if args.serve:
+            serve(downloader, args.serve)
+            return
+        failed = downloader.run()
+    finally:
+        progress.close()
 
-        except KeyboardInterrupt:
-            print(f"\nDownload of {clean} interrupted.")
-            raise
+    if failed:
+        print(f"{len(failed)} downloads failed:")
+        for job in failed:
+            print(f"  {job['clean']}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+"""Fault-injection soak test for download.py against a local stand-in server.
+
+Starts a StandInServer that injects dropped connections, 429/503 responses,
+stalls, truncated bodies and wrong Content-Lengths, then runs download.py
+over the whole playlist until it completes, re-running it as a user would
+after a failed run. Reports time to completion, goodput and the bytes sent
+that did not end up in a file, and checks every final file in the output
+directory against the server's content after each run.
+
+Exits with status 1 if any final file is corrupt or the sync never completes.
+
+    python soak.py --scale 0.05
+    python soak.py --faults drop=0.1,stall=0.02 --args "-j 8 --segments 4"
+"""
+
+import argparse
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from download import FLP_PLAYLIST, build_filename, hash_file
+from standin import StandInServer, parse_faults
+
+DOWNLOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "download.py")
+
+DEFAULT_FAULTS = "drop=0.05,error=0.05,stall=0.01,truncate=0.05,length=0.02"
+# Short enough that stalls are detected quickly, and shorter than the stall
+READ_TIMEOUT = 2
+STALL_SECONDS = 3 * READ_TIMEOUT
+DOWNLOADER_ARGS = f"-j 4 --read-timeout {READ_TIMEOUT} --backoff 0.2"
+
+MB = 1024 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Soak-test download.py against a server that injects faults",
+    )
+    parser.add_argument(
+        "--faults",
+        type=parse_faults,
+        default=DEFAULT_FAULTS,
+        metavar="NAME=P[,...]",
+        help=f"Fault probabilities per request (default: {DEFAULT_FAULTS})",
+    )
+    parser.add_argument(
+        "--args",
+        type=shlex.split,
+        default=DOWNLOADER_ARGS,
+        help=f'Arguments for download.py (default: "{DOWNLOADER_ARGS}")',
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["m4a", "ogg"],
+        default="m4a",
+        help="Audio format to sync (default: m4a)",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=0.05,
+        help="Multiply realistic file sizes by this factor (default: 0.05)",
+    )
+    parser.add_argument(
+        "--stall",
+        type=float,
+        default=STALL_SECONDS,
+        metavar="SECONDS",
+        help="How long a stall fault holds the connection (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for choosing faults (default: 0)",
+    )
+    parser.add_argument(
+        "--max-runs",
+        type=int,
+        default=10,
+        metavar="N",
+        help="Give up if the sync has not completed after N runs (default: 10)",
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the output directory instead of deleting it",
+    )
+    return parser.parse_args()
+
+
+def expected_files(server, file_format):
+    """Map each output filename to the synthetic file it should contain."""
+    key = "m4a" if file_format == "m4a" else "oga"
+    return {
+        build_filename(item["title"], False, file_format): server.files["/" + item[key]]
+        for item in FLP_PLAYLIST
+    }
+
+
+def check_files(output_dir, expected, digests):
+    """Compare every final file in `output_dir` with its expected content.
+
+    Partial files are ignored, since they are allowed to be incomplete.
+    Returns the names of corrupt files and the number of complete ones.
+    """
+    corrupt = []
+    complete = 0
+    for name, file in expected.items():
+        path = os.path.join(output_dir, name)
+        if not os.path.exists(path):
+            continue
+        if name not in digests:
+            digests[name] = file.digest()
+        if (
+            os.path.getsize(path) != file.size
+            or hash_file(path, hasher=hashlib.sha256()).hexdigest() != digests[name]
+        ):
+            corrupt.append(name)
+        else:
+            complete += 1
+    return corrupt, complete
+
+
+def main():
+    args = parse_args()
+
+    server = StandInServer(
+        ("127.0.0.1", 0),
+        args.scale,
+        faults=args.faults,
+        stall=args.stall,
+        seed=args.seed,
+    ).start()
+    expected = expected_files(server, args.format)
+    payload = sum(file.size for file in expected.values())
+    print(
+        f"Syncing {len(expected)} files ({payload / MB:.1f} MB) from {server.url} "
+        f"with faults {args.faults}"
+    )
+
+    output_dir = tempfile.mkdtemp(prefix="flp_soak_")
+    command = [
+        sys.executable,
+        DOWNLOADER,
+        "-o",
+        output_dir,
+        "--base-url",
+        server.url,
+        "-f",
+        args.format,
+        *args.args,
+    ]
+    digests = {}
+    corrupt = set()
+    complete = 0
+    runs = 0
+    started = time.monotonic()
+    try:
+        while runs < args.max_runs:
+            runs += 1
+            run_started = time.monotonic()
+            result = subprocess.run(command, stdout=subprocess.DEVNULL)
+            found, complete = check_files(output_dir, expected, digests)
+            corrupt.update(found)
+            print(
+                f"Run {runs}: exit {result.returncode} after "
+                f"{time.monotonic() - run_started:.1f}s, "
+                f"{complete}/{len(expected)} files complete, "
+                f"{len(found)} corrupt"
+            )
+            if result.returncode == 0 and complete == len(expected):
+                break
+        elapsed = time.monotonic() - started
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"Output kept in {output_dir}")
+        else:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    sent = server.stats["bytes_sent"]
+    wasted = max(0, sent - payload)
+    faults = ", ".join(
+        f"{name} {count}" for name, count in sorted(server.stats["faults"].items())
+    )
+    print(f"Requests:        {server.stats['requests']}")
+    print(f"Faults injected: {faults or 'none'}")
+    print(f"Completion time: {elapsed:.1f}s over {runs} run(s)")
+    print(f"Goodput:         {payload / MB / elapsed:.1f} MB/s")
+    print(
+        f"Wasted bytes:    {wasted / MB:.1f} MB "
+        f"({wasted / payload:.1%} of the payload sent again)"
+    )
+
+    if corrupt:
+        print(f"FAIL: {len(corrupt)} corrupt final file(s):")
+        for name in sorted(corrupt):
+            print(f"  {name}")
+        sys.exit(1)
+    if complete < len(expected):
+        print(f"FAIL: sync incomplete after {runs} run(s)")
+        sys.exit(1)
+    print("OK: every final file matches upstream")
+
+
+if __name__ == "__main__":
+    main()
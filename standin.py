@@ -0,0 +1,563 @@
+"""Local stand-in for the lecture server, for benchmarks and tests.
+
+Serves synthetic files at the same paths as FLP_PLAYLIST, with sizes close to
+the real lectures, and supports the HTTP features download.py relies on:
+HEAD, byte ranges with If-Range, conditional requests, and optionally
+chunked bodies and redirects. The playlist
+page (flptapes.html) is generated from the same entries, or can be a saved
+copy of the real one to test the catalog parser against. Latency,
+per-connection and total bandwidth, and a limit on concurrent transfers can
+be configured to mimic a remote server, and faults can be injected to test
+recovery (see FAULTS).
+
+    python standin.py --port 8000 --scale 0.1
+    python standin.py --faults drop=0.05,error=0.05,stall=0.01
+    python standin.py --bandwidth 1M --capacity 8M --max-active 12
+    python standin.py --chunked
+    python standin.py --page tests/data/flptapes.html
+    python download.py --base-url http://127.0.0.1:8000/
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from download import CATALOG_PAGE, FLP_PLAYLIST, TokenBucket, parse_size
+
+RANGE_REGEX = r"bytes=(\d*)-(\d*)"
+
+# Content repeats with a prime period, so a byte spliced in at the wrong
+# offset is detected unless the error is a multiple of it
+BLOCK_SIZE = 65521
+WRITE_SIZE = 64 * 1024
+
+# Real lectures are 45-55 minute recordings of roughly these sizes
+M4A_SIZE = 24 * 1024 * 1024
+OGG_SIZE = 20 * 1024 * 1024
+SIZE_SPREAD = 0.2
+
+LAST_MODIFIED = 1_600_000_000
+
+# Faults that can be injected, each with the probability of hitting a request:
+#   drop      reset the connection partway through the body
+#   error     answer 429 or 503 with a short Retry-After
+#   stall     stop sending partway through the body for `stall` seconds
+#   truncate  close the connection cleanly partway through the body
+#   length    send a Content-Length shorter than the body, then the whole body
+FAULTS = ("drop", "error", "stall", "truncate", "length")
+BODY_FAULTS = ("drop", "stall", "truncate", "length")
+ERROR_STATUSES = (429, 503)
+RETRY_AFTER = 1
+STALL_SECONDS = 10.0
+
+
+class SyntheticFile:
+    """Deterministic content for one path, generated on the fly."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        seed = hashlib.sha256(path.encode()).digest()
+        block = random.Random(seed).randbytes(BLOCK_SIZE)
+        self._doubled = block + block
+        self.etag = f'"{seed[:8].hex()}-{size:x}"'
+        self.last_modified = formatdate(LAST_MODIFIED, usegmt=True)
+
+    def read(self, offset, length):
+        """Return up to BLOCK_SIZE bytes of content starting at `offset`."""
+        start = offset % BLOCK_SIZE
+        return self._doubled[start : start + min(length, BLOCK_SIZE)]
+
+    def digest(self):
+        """Return the SHA-256 of the whole file, as download.py records it."""
+        hasher = hashlib.sha256()
+        offset = 0
+        while offset < self.size:
+            chunk = self.read(offset, self.size - offset)
+            hasher.update(chunk)
+            offset += len(chunk)
+        return hasher.hexdigest()
+
+
+class StaticFile:
+    """Fixed content, such as the playlist page, served like a synthetic file."""
+
+    def __init__(self, path, content):
+        self.path = path
+        self.content = content
+        self.size = len(content)
+        self.etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+        self.last_modified = formatdate(LAST_MODIFIED, usegmt=True)
+
+    def read(self, offset, length):
+        """Return up to WRITE_SIZE bytes of content starting at `offset`."""
+        return self.content[offset : offset + min(length, WRITE_SIZE)]
+
+
+def catalog_page(playlist):
+    """Render `playlist` as a jPlayer playlist page like flptapes.html."""
+    entries = ",\n".join(
+        "    {\n"
+        + ",\n".join(
+            f"      {key}:{json.dumps(item[key], ensure_ascii=False)}"
+            for key in ("title", "m4a", "oga")
+        )
+        + "\n    }"
+        for item in playlist
+    )
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>The Feynman Lectures on Physics - Original Course Audio</title>
+<script type="text/javascript">
+$(document).ready(function(){{
+  new jPlayerPlaylist({{
+    jPlayer: "#jquery_jplayer_1",
+    cssSelectorAncestor: "#jp_container_1"
+  }}, [
+{entries}
+  ], {{
+    swfPath: "js",
+    supplied: "m4a, oga"
+  }});
+}});
+</script>
+</head>
+<body></body>
+</html>
+"""
+
+
+def playlist_files(scale=1.0):
+    """Build the synthetic files for every FLP_PLAYLIST entry and format."""
+    files = {}
+    for item in FLP_PLAYLIST:
+        for key, base in (("m4a", M4A_SIZE), ("oga", OGG_SIZE)):
+            path = "/" + item[key]
+            spread = random.Random(path).uniform(-SIZE_SPREAD, SIZE_SPREAD)
+            files[path] = SyntheticFile(path, max(1, int(base * (1 + spread) * scale)))
+    return files
+
+
+class StandInServer(ThreadingHTTPServer):
+    """HTTP server for the synthetic playlist files.
+
+    `latency` is the delay in seconds before each response, and `bandwidth`
+    the maximum bytes per second sent on each connection (unlimited if None).
+    `capacity` caps the bytes per second sent on all connections together,
+    and beyond `max_active` bodies being sent at once, requests for files are
+    answered with 503, as by an overloaded server. `page` is the content of the
+    playlist page, generated from FLP_PLAYLIST by default. `faults` maps names
+    from FAULTS to the probability of injecting them into a request, drawn from
+    a generator seeded with `seed`. With `chunked`, whole files are sent with
+    chunked transfer encoding instead of a Content-Length, and `redirects`
+    maps paths to the Location they are redirected to with a 302. Counts of
+    connections, requests, bytes sent and faults injected are kept in `stats`.
+    """
+
+    daemon_threads = True
+    # socketserver's default backlog of 5 drops connections opened in a burst,
+    # as a client running hundreds of downloads at once does
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        address,
+        scale=1.0,
+        latency=0.0,
+        bandwidth=None,
+        faults=None,
+        stall=STALL_SECONDS,
+        seed=0,
+        page=None,
+        capacity=None,
+        max_active=None,
+        chunked=False,
+        redirects=None,
+    ):
+        super().__init__(address, StandInHandler)
+        self.files = playlist_files(scale)
+        page_path = "/" + CATALOG_PAGE
+        if page is None:
+            page = catalog_page(FLP_PLAYLIST).encode()
+        self.files[page_path] = StaticFile(page_path, page)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.faults = faults or {}
+        self.stall = stall
+        self.capacity = TokenBucket(capacity) if capacity else None
+        self.max_active = max_active
+        self.chunked = chunked
+        self.redirects = redirects or {}
+        self.active = 0
+        self.stats = {
+            "connections": 0,
+            "requests": 0,
+            "bytes_sent": 0,
+            "faults": {},
+            "rejected": 0,
+        }
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        """Base URL to pass to download.py as --base-url."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def count(self, requests=0, bytes_sent=0, connections=0):
+        """Add to the connection, request and byte counters."""
+        with self._lock:
+            self.stats["connections"] += connections
+            self.stats["requests"] += requests
+            self.stats["bytes_sent"] += bytes_sent
+
+    def enter(self):
+        """Claim a place for sending a body, or count a rejection and return False."""
+        with self._lock:
+            if self.max_active and self.active >= self.max_active:
+                self.stats["rejected"] += 1
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.active -= 1
+
+    def draw_fault(self, candidates):
+        """Pick at most one of `candidates` to inject, counting it in `stats`.
+
+        Returns the fault's name and a fraction in [0, 1) for where in the
+        body to inject it, or (None, None).
+        """
+        with self._lock:
+            roll = self._random.random()
+            for name in candidates:
+                roll -= self.faults.get(name, 0.0)
+                if roll < 0:
+                    counts = self.stats["faults"]
+                    counts[name] = counts.get(name, 0) + 1
+                    return name, self._random.random()
+        return None, None
+
+    def handle_error(self, request, client_address):
+        # Clients dropping connections, e.g. after a fault, are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        """Serve in a background thread and return self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.count(connections=1)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        if not self.server.enter():
+            self.server.count(requests=1)
+            self.send_retry(503)
+            return
+        try:
+            self.respond(send_body=True)
+        finally:
+            self.server.leave()
+
+    def respond(self, send_body):
+        self.server.count(requests=1)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        path = urllib.parse.unquote(self.path.split("?")[0])
+        location = self.server.redirects.get(path)
+        if location:
+            self.send_response(302)
+            self.send_header("Location", location)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        file = self.server.files.get(path)
+        if file is None:
+            self.send_error(404)
+            return
+
+        fault, where = self.server.draw_fault(FAULTS if send_body else ("error",))
+        if fault == "error":
+            self.send_retry(random.choice(ERROR_STATUSES))
+            return
+
+        if self.not_modified(file):
+            self.send_response(304)
+            self.send_validators(file)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end = 0, file.size - 1
+        byte_range = self.requested_range(file)
+        if byte_range == "invalid":
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{file.size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{file.size}")
+        else:
+            self.send_response(200)
+        self.send_validators(file)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        length = end - start + 1
+        chunked = self.server.chunked and not byte_range and fault != "length"
+        if fault == "length":
+            # The excess stays on the connection and garbles the next response
+            length = int(length * where)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+        if not send_body:
+            return
+        if fault not in BODY_FAULTS or fault == "length":
+            self.send_body(file, start, end + 1, chunked)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+            return
+
+        self.send_body(file, start, start + int((end - start + 1) * where), chunked)
+        if fault == "stall":
+            time.sleep(self.server.stall)
+        elif fault == "drop":
+            # Closing with a zero linger time sends a reset instead of a FIN
+            self.connection.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+            )
+        self.close_connection = True
+
+    def send_retry(self, status):
+        """Answer with an error status asking the client to come back shortly."""
+        self.send_response(status)
+        self.send_header("Retry-After", str(RETRY_AFTER))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_validators(self, file):
+        self.send_header("ETag", file.etag)
+        self.send_header("Last-Modified", file.last_modified)
+
+    def not_modified(self, file):
+        """Whether the request's conditional headers match the current file."""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return file.etag in [tag.strip() for tag in if_none_match.split(",")]
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return LAST_MODIFIED <= since
+        return False
+
+    def requested_range(self, file):
+        """Return the (start, end) range to serve, None for all, or "invalid"."""
+        header = self.headers.get("Range")
+        if not header:
+            return None
+
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range not in (file.etag, file.last_modified):
+            return None
+
+        match = re.fullmatch(RANGE_REGEX, header.strip())
+        if not match or match.groups() == ("", ""):
+            return None
+
+        first, last = match.groups()
+        if not first:
+            start, end = max(0, file.size - int(last)), file.size - 1
+        else:
+            start = int(first)
+            end = min(int(last), file.size - 1) if last else file.size - 1
+        if start >= file.size or start > end:
+            return "invalid"
+        return start, end
+
+    def send_body(self, file, offset, stop, chunked=False):
+        # Each chunk is paced before it is sent rather than after, so the
+        # connection isn't held up once the body is out, and the next request
+        # on it gets a prompt response as over a real link
+        started = time.monotonic()
+        sent = 0
+        while offset < stop:
+            chunk = file.read(offset, min(WRITE_SIZE, stop - offset))
+            sent += len(chunk)
+            if self.server.capacity:
+                self.server.capacity.consume(len(chunk))
+            if self.server.bandwidth:
+                delay = sent / self.server.bandwidth - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            if chunked:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            else:
+                self.wfile.write(chunk)
+            self.server.count(bytes_sent=len(chunk))
+            offset += len(chunk)
+
+
+def parse_faults(value):
+    """Argparse type for --faults NAME=PROBABILITY[,...]."""
+    faults = {}
+    for item in value.split(","):
+        name, _, probability = item.partition("=")
+        name = name.strip()
+        if name not in FAULTS:
+            raise argparse.ArgumentTypeError(
+                f"Unknown fault: {name} (choose from {', '.join(FAULTS)})"
+            )
+        try:
+            faults[name] = float(probability)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid probability: {item}")
+        if not 0 <= faults[name] <= 1:
+            raise argparse.ArgumentTypeError(f"Invalid probability: {item}")
+    if sum(faults.values()) > 1:
+        raise argparse.ArgumentTypeError("Fault probabilities add up to over 1")
+    return faults
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve synthetic Feynman Lectures files for local testing",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to bind")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiply realistic file sizes by this factor (default: 1.0)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="Delay before each response (default: 0)",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=parse_size,
+        metavar="RATE",
+        help="Maximum bytes per second per connection, e.g. 2M (default: unlimited)",
+    )
+    parser.add_argument(
+        "--page",
+        metavar="FILE",
+        help=f"Serve a saved copy of {CATALOG_PAGE} instead of generating one",
+    )
+    parser.add_argument(
+        "--faults",
+        type=parse_faults,
+        metavar="NAME=P[,...]",
+        help=f"Inject faults with the given probabilities ({', '.join(FAULTS)})",
+    )
+    parser.add_argument(
+        "--stall",
+        type=float,
+        default=STALL_SECONDS,
+        metavar="SECONDS",
+        help="How long a stall fault holds the connection (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--capacity",
+        type=parse_size,
+        metavar="RATE",
+        help="Total bytes per second sent on all connections, e.g. 8M "
+        "(default: unlimited)",
+    )
+    parser.add_argument(
+        "--max-active",
+        type=int,
+        metavar="N",
+        help="Answer 503 to requests beyond N transfers at once (default: no limit)",
+    )
+    parser.add_argument(
+        "--chunked",
+        action="store_true",
+        help="Send whole files with chunked transfer encoding instead of a "
+        "Content-Length",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for choosing faults (default: 0)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    page = None
+    if args.page:
+        with open(args.page, "rb") as f:
+            page = f.read()
+    server = StandInServer(
+        (args.host, args.port),
+        args.scale,
+        args.latency,
+        args.bandwidth,
+        args.faults,
+        args.stall,
+        args.seed,
+        page,
+        args.capacity,
+        args.max_active,
+        args.chunked,
+    )
+    print(
+        f"Serving {len(server.files) - 1} synthetic files and {CATALOG_PAGE} "
+        f"at {server.url}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
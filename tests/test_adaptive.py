@@ -0,0 +1,69 @@
+"""Tests for AdaptiveLimiter, fed synthetic transfers on a fake clock.
+
+python -m pytest tests
+"""
+
+import unittest
+from unittest import mock
+
+from download import ADAPTIVE_INTERVAL, AdaptiveLimiter, Event, HostLimiter, Transfer
+
+MB = 1024 * 1024
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        patcher = mock.patch("time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.events = []
+        self.limiter = AdaptiveLimiter(16, HostLimiter(16), self.events.append)
+        self.limiter.limit = 8
+
+    def interval(self, received, ttfb):
+        """Finish one transfer of `received` bytes, then adjust the limit."""
+        transfer = Transfer({"url": "http://host/file", "size": received})
+        self.limiter.emit(Event("started", transfer.job, transfer))
+        transfer.responded = transfer.started + ttfb
+        transfer.received = received
+        self.limiter.emit(Event("done", transfer.job, transfer))
+        self.now += ADAPTIVE_INTERVAL
+        self.limiter.adjust()
+
+    def concurrency(self):
+        return [e.message for e in self.events if e.kind == "concurrency"]
+
+    def test_slower_first_byte_with_flat_throughput_cuts(self):
+        self.interval(8 * MB, 0.05)
+        self.interval(8 * MB, 0.05)
+        self.interval(8 * MB, 0.8)
+        self.assertEqual(self.limiter.limit, 6)
+        self.assertIn("time to first byte up to 800 ms", self.concurrency()[0])
+
+    def test_slower_first_byte_with_rising_throughput_is_kept(self):
+        self.interval(8 * MB, 0.05)
+        self.interval(8 * MB, 0.05)
+        self.interval(12 * MB, 0.8)
+        self.assertEqual(self.limiter.limit, 8)
+        self.assertEqual(self.concurrency(), [])
+
+    def test_first_byte_within_margin_is_kept(self):
+        self.interval(8 * MB, 0.05)
+        self.interval(8 * MB, 0.05)
+        self.interval(8 * MB, 0.3)
+        self.assertEqual(self.limiter.limit, 8)
+
+    def test_overload_halves(self):
+        self.interval(8 * MB, 0.05)
+        transfer = Transfer({"url": "http://host/file", "size": MB})
+        self.limiter.emit(Event("started", transfer.job, transfer))
+        error = TimeoutError("read timed out")
+        self.limiter.emit(Event("retrying", transfer.job, transfer, error=error))
+        self.now += ADAPTIVE_INTERVAL
+        self.limiter.adjust()
+        self.assertEqual(self.limiter.limit, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+"""Tests for AsyncHTTPClient, the asyncio engine's HTTP client, against standin.py.
+
+python -m pytest tests
+"""
+
+import asyncio
+import contextlib
+import tempfile
+import unittest
+
+from download import (
+    MAX_REDIRECTS,
+    AsyncHTTPClient,
+    Downloader,
+    HTTPStatusError,
+    InvalidRequest,
+)
+from standin import StandInServer, StaticFile
+
+PATH = "/protectedaudio/mp4/FLP_1_01R.mp4"
+QUOTED_PATH = "/protectedaudio/a b/Schrödinger (1).mp4"
+
+
+def content(file):
+    """Return the whole content of a stand-in file."""
+    chunks = []
+    offset = 0
+    while offset < file.size:
+        chunks.append(file.read(offset, file.size - offset))
+        offset += len(chunks[-1])
+    return b"".join(chunks)
+
+
+async def fetch(client, url, limit=None):
+    """GET `url`, returning the response and its body, or its first `limit` bytes."""
+    body = bytearray()
+    with await client.get(url) as response:
+        response.raise_for_status()
+        async for chunk in response.iter_content(4096):
+            body += chunk
+            if limit is not None and len(body) >= limit:
+                break
+    return response, bytes(body)
+
+
+class ClientTest(unittest.TestCase):
+    chunked = False
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInServer(
+            ("127.0.0.1", 0),
+            scale=0.001,
+            chunked=cls.chunked,
+            redirects={"/old": PATH, "/loop": "/loop"},
+        ).start()
+        cls.server.files[QUOTED_PATH] = StaticFile(QUOTED_PATH, b"quoted" * 1000)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def run_client(self, test):
+        """Run `test(client)` on a new event loop, with a new client."""
+
+        async def run():
+            client = AsyncHTTPClient((5, 5))
+            try:
+                return await test(client)
+            finally:
+                client.close()
+
+        return asyncio.run(run())
+
+    def url(self, path):
+        return self.server.url.rstrip("/") + path
+
+    def connections(self):
+        return self.server.stats["connections"]
+
+    def test_body_and_reuse(self):
+        async def test(client):
+            before = self.connections()
+            for _ in range(3):
+                response, body = await fetch(client, self.url(PATH))
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(body, content(self.server.files[PATH]))
+            # Each response was read to its end, so one connection served all
+            self.assertEqual(self.connections() - before, 1)
+
+        self.run_client(test)
+
+    def test_reuse_after_partial_read(self):
+        async def test(client):
+            before = self.connections()
+            await fetch(client, self.url(PATH), limit=4096)
+            # The rest of the body is still on that connection, so it is closed
+            _, body = await fetch(client, self.url(PATH))
+            self.assertEqual(body, content(self.server.files[PATH]))
+            await fetch(client, self.url(PATH))
+            self.assertEqual(self.connections() - before, 2)
+
+        self.run_client(test)
+
+    def test_redirect(self):
+        async def test(client):
+            response, body = await fetch(client, self.url("/old"))
+            self.assertEqual(response.url, self.url(PATH))
+            self.assertEqual(body, content(self.server.files[PATH]))
+            with self.assertRaises(HTTPStatusError) as raised:
+                await client.get(self.url("/loop"))
+            self.assertEqual(raised.exception.response.status_code, 302)
+
+        before = self.server.stats["requests"]
+        self.run_client(test)
+        self.assertEqual(self.server.stats["requests"] - before, 2 + MAX_REDIRECTS + 1)
+
+    def test_quoted_path(self):
+        async def test(client):
+            _, body = await fetch(client, self.url(QUOTED_PATH))
+            self.assertEqual(body, self.server.files[QUOTED_PATH].content)
+            # Escapes already in the URL are kept as they are
+            quoted = QUOTED_PATH.replace(" ", "%20")
+            _, body = await fetch(client, self.url(quoted) + "?a=b c")
+            self.assertEqual(body, self.server.files[QUOTED_PATH].content)
+
+        self.run_client(test)
+
+    def test_invalid_request(self):
+        async def test(client):
+            for url, headers in (
+                ("http://127.0.0.1:99999/", None),
+                ("ftp://127.0.0.1/", None),
+                (self.url(PATH), {"If-None-Match": "☃"}),
+                (self.url(PATH), {"If-None-Match": '"a"\r\nX-Injected: 1'}),
+            ):
+                with self.subTest(url=url, headers=headers):
+                    with self.assertRaises(InvalidRequest):
+                        await client.get(url, headers)
+
+        self.run_client(test)
+
+
+class ChunkedClientTest(ClientTest):
+    chunked = True
+
+
+class InvalidRequestJobTest(unittest.TestCase):
+    def test_fails_only_its_job(self):
+        with tempfile.TemporaryDirectory() as directory:
+            downloader = Downloader(
+                base_url="http://127.0.0.1:99999/",
+                output_dir=directory,
+                lectures="1-2",
+                engine="asyncio",
+                sink=lambda event: None,
+            )
+            with contextlib.closing(downloader):
+                failed = downloader.run()
+        self.assertEqual(len(failed), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+"""Tests for matching cache entries against upstream.
+
+python -m pytest tests
+"""
+
+import hashlib
+import os
+import tempfile
+import unittest
+
+from download import Cache
+
+URL = "http://host/protectedaudio/mp4/FLP_1_01R.mp4"
+BODY = b"atoms in motion"
+ETAG = '"abc"'
+LAST_MODIFIED = "Tue, 26 Sep 1961 10:00:00 GMT"
+
+
+class CacheMatchTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = Cache(os.path.join(directory.name, "cache"))
+        self.path = os.path.join(directory.name, "file")
+        with open(self.path, "wb") as f:
+            f.write(BODY)
+
+    def add(self, **validators):
+        entry = {
+            "url": URL,
+            "size": len(BODY),
+            "checksum": "sha256:" + hashlib.sha256(BODY).hexdigest(),
+            **validators,
+        }
+        self.cache.add(self.path, entry)
+        return entry
+
+    def test_etag(self):
+        entry = self.add(etag=ETAG, last_modified=LAST_MODIFIED)
+        self.assertEqual(self.cache.match(URL, len(BODY), ETAG), entry)
+        self.assertIsNone(self.cache.match(URL, len(BODY), '"def"', LAST_MODIFIED))
+
+    def test_last_modified_without_etag(self):
+        entry = self.add(last_modified=LAST_MODIFIED)
+        self.assertEqual(self.cache.match(URL, len(BODY), ETAG, LAST_MODIFIED), entry)
+        later = "Fri, 29 Sep 1961 10:00:00 GMT"
+        self.assertIsNone(self.cache.match(URL, len(BODY), None, later))
+
+    def test_size(self):
+        self.add(etag=ETAG)
+        self.assertIsNone(self.cache.match(URL, len(BODY) + 1, ETAG))
+
+    def test_unchecked(self):
+        entry = self.add(etag=ETAG)
+        self.assertEqual(self.cache.get(URL), entry)
+        # Nothing known upstream, or nothing to compare, is not a match
+        self.assertIsNone(self.cache.match(URL, None))
+        self.assertIsNone(self.cache.match(URL, len(BODY)))
+        self.assertIsNone(self.cache.match(URL, len(BODY), None, LAST_MODIFIED))
+
+    def test_missing_blob(self):
+        entry = self.add(etag=ETAG)
+        os.remove(self.cache.blob_path(entry["checksum"]))
+        self.assertIsNone(self.cache.match(URL, len(BODY), ETAG))
+
+
+if __name__ == "__main__":
+    unittest.main()
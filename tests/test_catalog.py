@@ -0,0 +1,121 @@
+"""Tests for the catalog parser, against a page served locally.
+
+tests/data/flptapes.html is laid out like the live page but is not a saved copy
+of it: its entries are transcribed from FLP_PLAYLIST, so it checks that the
+parser reads that layout, not that it still matches the site's markup.
+
+python -m pytest tests
+"""
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from download import (
+    CATALOG_PAGE,
+    catalog_path,
+    load_catalog,
+    parse_args,
+    parse_catalog,
+    refresh_catalog,
+)
+from standin import StandInServer
+
+SAVED_PAGE = os.path.join(os.path.dirname(__file__), "data", CATALOG_PAGE)
+
+
+class SavedPageTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(SAVED_PAGE, "rb") as f:
+            page = f.read()
+        cls.server = StandInServer(("127.0.0.1", 0), scale=0.001, page=page).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_refresh(self):
+        with tempfile.TemporaryDirectory() as directory:
+            args = parse_args(["--base-url", self.server.url, "-o", directory])
+            path = catalog_path(args)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                refresh_catalog(args, path)
+                playlist = load_catalog(path)["playlist"]
+                refresh_catalog(args, path)
+            self.assertIn("Catalog is up to date", output.getvalue())
+
+        self.assertEqual(len(playlist), 121)
+        self.assertEqual(
+            playlist[0],
+            {
+                "title": "<span>#1</span> Atoms in motion (9/26/61)",
+                "m4a": "protectedaudio/mp4/FLP_1_01R.mp4",
+                "oga": "protectedaudio/ogg/FLP_1_01R.ogg",
+            },
+        )
+        titles = [item["title"] for item in playlist]
+        self.assertIn("<span class='nonum'></span> Review Lecture A (12/1/61)", titles)
+        self.assertEqual(
+            playlist[-1]["title"],
+            "<span>#S64</span> The Schrödinger equation in a classical context: "
+            "superconductivity (6/4/64)",
+        )
+        self.assertEqual(playlist[-1]["m4a"], "protectedaudio/mp4/FLP_S64_01.mp4")
+
+
+class ValidationTest(unittest.TestCase):
+    def parse(self, *entries):
+        """Parse a page of (title, m4a, oga) entries; return items and problems."""
+        page = ",".join(
+            "{title:%s, m4a:%s, oga:%s}" % tuple(map(json.dumps, entry))
+            for entry in entries
+        )
+        problems = []
+        return parse_catalog(page, problems.append), problems
+
+    def test_valid_entry(self):
+        entry = ("<span>#1</span> Atoms (9/26/61)", "mp4/1.mp4", "ogg/1.ogg")
+        playlist, problems = self.parse(entry)
+        self.assertEqual(playlist, [dict(zip(("title", "m4a", "oga"), entry))])
+        self.assertEqual(problems, [])
+
+    def test_off_site_paths(self):
+        playlist, problems = self.parse(
+            ("<span>#1</span> A (9/26/61)", "https://example.com/1.mp4", "1.ogg"),
+            ("<span>#2</span> B (9/27/61)", "2.mp4", "//example.com/2.ogg"),
+        )
+        self.assertEqual(playlist, [])
+        self.assertEqual(len(problems), 2)
+
+    def test_path_separator_in_title(self):
+        playlist, problems = self.parse(
+            ("<span>#1</span> ../../etc (9/26/61)", "1.mp4", "1.ogg"),
+            ("<span>#2</span> A\\B (9/27/61)", "2.mp4", "2.ogg"),
+        )
+        self.assertEqual(playlist, [])
+        self.assertEqual(len(problems), 2)
+
+    def test_duplicate_filename(self):
+        playlist, problems = self.parse(
+            ("<span>#1</span> Atoms (9/26/61)", "1.mp4", "1.ogg"),
+            ("<span>#1</span> Atoms (9/26/61)", "1b.mp4", "1b.ogg"),
+            # Same name once dates are left out with --no-date
+            ("<span>#1</span> Atoms (9/28/61)", "1c.mp4", "1c.ogg"),
+        )
+        self.assertEqual([item["m4a"] for item in playlist], ["1.mp4"])
+        self.assertEqual(len(problems), 2)
+
+    def test_missing_date(self):
+        playlist, problems = self.parse(("<span>#1</span> Atoms", "1.mp4", "1.ogg"))
+        self.assertEqual(playlist, [])
+        self.assertEqual(len(problems), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""Tests for file leases shared between runs in one output directory.
+
+python -m pytest tests
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from download import LEASE_SUFFIX, Leases, read_lease
+
+
+def dead_pid():
+    """Return the PID of a process that has exited."""
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+class LeasesTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "file.m4a")
+        self.lease_path = self.path + LEASE_SUFFIX
+        self.leases = Leases(ttl=60)
+
+    def write_lease(self, **holder):
+        holder = {
+            "host": self.leases.host,
+            "pid": os.getpid(),
+            "token": "other",
+            "expires": time.time() + 60,
+            **holder,
+        }
+        with open(self.lease_path, "w") as f:
+            json.dump(holder, f)
+        return holder
+
+    def assertClaimed(self):
+        self.assertEqual(self.leases.claim(self.path), self.lease_path)
+        self.assertEqual(read_lease(self.lease_path)["token"], self.leases.token)
+
+    def test_claim_and_release(self):
+        self.assertClaimed()
+        self.assertIsNone(Leases().claim(self.path))
+        self.leases.release(self.lease_path)
+        self.assertFalse(os.path.exists(self.lease_path))
+        self.assertIsNotNone(Leases().claim(self.path))
+
+    def test_release_leaves_other_holders(self):
+        self.assertClaimed()
+        holder = self.write_lease()
+        self.leases.release(self.lease_path)
+        self.assertEqual(read_lease(self.lease_path), holder)
+
+    def test_live_holder(self):
+        holder = self.write_lease()
+        self.assertIsNone(self.leases.claim(self.path))
+        self.assertEqual(read_lease(self.lease_path), holder)
+
+    def test_expired(self):
+        self.write_lease(host="elsewhere", expires=time.time() - 1)
+        self.assertClaimed()
+
+    def test_dead_holder_on_this_host(self):
+        self.write_lease(pid=dead_pid())
+        self.assertClaimed()
+
+    def test_dead_pid_on_another_host(self):
+        # The PID means nothing here, so only expiry frees the lease
+        holder = self.write_lease(host="elsewhere", pid=dead_pid())
+        self.assertIsNone(self.leases.claim(self.path))
+        self.assertEqual(read_lease(self.lease_path), holder)
+
+    def test_unreadable(self):
+        open(self.lease_path, "w").close()
+        self.assertIsNone(self.leases.claim(self.path))
+        old = time.time() - 120
+        os.utime(self.lease_path, (old, old))
+        self.assertClaimed()
+
+    def test_break_after_replacement(self):
+        stale = self.write_lease(expires=time.time() - 1)
+        # Another process breaks the stale lease and claims the file first
+        fresh = self.write_lease(token="fresh")
+        self.assertFalse(self.leases._break(self.lease_path, stale))
+        self.assertEqual(read_lease(self.lease_path), fresh)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["file.m4a.lease"])
+
+    def test_break(self):
+        stale = self.write_lease(expires=time.time() - 1)
+        self.assertTrue(self.leases._break(self.lease_path, stale))
+        self.assertFalse(os.path.exists(self.lease_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+"""Tests for Downloader keyword options, checked as on the command line.
+
+python -m pytest tests
+"""
+
+import contextlib
+import io
+import unittest
+
+from download import Downloader, parse_args, parse_options
+
+
+class ParseOptionsTest(unittest.TestCase):
+    def test_values(self):
+        args = parse_options({"lectures": "1-3,R", "jobs": 4, "verbose": True})
+        self.assertEqual(args.jobs, 4)
+        self.assertTrue(args.verbose)
+        self.assertEqual(
+            args.lectures,
+            [("", (1, ""), (3, "~")), ("R", (0, ""), (0, "~"))],
+        )
+        self.assertEqual(args.chunk_size, parse_args([]).chunk_size)
+
+    def test_based_on_args(self):
+        base = parse_args(["-j", "3", "--lectures", "5"])
+        args = parse_options({"verbose": True}, base)
+        self.assertIsNot(args, base)
+        self.assertEqual((args.jobs, args.lectures), (3, base.lectures))
+        self.assertTrue(args.verbose)
+        self.assertFalse(base.verbose)
+
+    def test_flags_can_be_cleared(self):
+        base = parse_args(["--sync"])
+        self.assertFalse(parse_options({"sync": False}, base).sync)
+
+    def test_type_errors(self):
+        for options in (
+            {"bogus": 1},
+            {"plan": True},
+            {"refresh_catalog": True},
+            {"verbose": "yes"},
+            {"lectures": [1, 2]},
+            {"jobs": True},
+        ):
+            with self.subTest(options=options):
+                with self.assertRaises(TypeError):
+                    parse_options(options)
+
+    def test_value_errors(self):
+        for options in (
+            {"jobs": "many"},
+            {"jobs": 0},
+            {"engine": "fibers"},
+            {"since": "1961-13"},
+            {"engine": "asyncio", "segments": 2},
+            {"engine": "asyncio", "adaptive": True},
+        ):
+            with self.subTest(options=options):
+                with self.assertRaises(ValueError):
+                    parse_options(options)
+
+    def test_downloader(self):
+        with self.assertRaises(ValueError):
+            Downloader(engine="asyncio", segments=2)
+        self.assertEqual(Downloader(jobs=2).args.jobs, 2)
+
+
+class ParseArgsTest(unittest.TestCase):
+    def test_same_checks(self):
+        for argv in (
+            ["--engine", "asyncio", "--segments", "2"],
+            ["--engine", "asyncio", "--adaptive"],
+            ["--plan", "--shard", "1/2", "--shard-by", "size"],
+        ):
+            with self.subTest(argv=argv):
+                with contextlib.redirect_stderr(io.StringIO()):
+                    with self.assertRaises(SystemExit):
+                        parse_args(argv)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""Tests for the lecture and date selectors.
+
+python -m pytest tests
+"""
+
+import argparse
+import unittest
+
+from download import FLP_PLAYLIST, clean_title, date_prefix, is_selected, parse_args
+
+
+def selected(*argv):
+    args = parse_args(list(argv))
+    return [
+        clean_title(item["title"]) for item in FLP_PLAYLIST if is_selected(item, args)
+    ]
+
+
+class LectureSelectorTest(unittest.TestCase):
+    def test_range_includes_lettered_lectures(self):
+        titles = selected("--lectures", "34-35")
+        self.assertEqual([title.split()[0] for title in titles], ["#34", "#34A", "#35"])
+
+    def test_review_lectures(self):
+        self.assertEqual(
+            selected("--lectures", "R"),
+            ["Review Lecture A", "Review Lecture B", "Review Lecture C"],
+        )
+        self.assertEqual(selected("--lectures", "rb"), ["Review Lecture B"])
+        self.assertEqual(
+            selected("--lectures", "RA-RB"), ["Review Lecture A", "Review Lecture B"]
+        )
+        # Numbered ranges leave them out, though they were given meanwhile
+        self.assertNotIn("Review Lecture A", selected("--lectures", "1-20"))
+
+    def test_invalid(self):
+        for value in ("RC-RA", "1-S2", "A1", "R1"):
+            with self.subTest(value=value):
+                with self.assertRaises(SystemExit):
+                    parse_args(["--lectures", value])
+
+
+class DatePrefixTest(unittest.TestCase):
+    def test_valid(self):
+        for value in ("1961", "1961-12", "1964-02-29"):
+            self.assertEqual(date_prefix(value), value)
+
+    def test_invalid(self):
+        for value in ("61", "1961-13", "1961-00", "1962-02-29", "1961-12-32"):
+            with self.subTest(value=value):
+                with self.assertRaises(argparse.ArgumentTypeError):
+                    date_prefix(value)
+
+    def test_since_until(self):
+        self.assertEqual(
+            selected("--since", "1961-12", "--until", "1961-12-05"),
+            ["Review Lecture A", "Review Lecture B"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Tests for the Range handling of --serve.
+
+python -m pytest tests
+"""
+
+import unittest
+
+from download import requested_range
+
+
+class RequestedRangeTest(unittest.TestCase):
+    def test_whole_file(self):
+        for header in (None, "", "bytes=0-", "bytes=-"):
+            with self.subTest(header=header):
+                self.assertEqual(requested_range(header, 1000), (0, 1000))
+
+    def test_ranges(self):
+        cases = {
+            "bytes=100-199": (100, 200),
+            "bytes=100-": (100, 1000),
+            "bytes=900-5000": (900, 1000),
+            "bytes=999-999": (999, 1000),
+            "bytes=-300": (700, 1000),
+            "bytes=-5000": (0, 1000),
+            " bytes=0-0 ": (0, 1),
+        }
+        for header, span in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(requested_range(header, 1000), span)
+
+    def test_ignored(self):
+        # Ranges that aren't single valid byte ranges ask for the whole file
+        for header in ("bytes=0-1,5-6", "items=0-1", "bytes=200-100", "bytes=a-b"):
+            with self.subTest(header=header):
+                self.assertEqual(requested_range(header, 1000), (0, 1000))
+
+    def test_unsatisfiable(self):
+        for header, size in (
+            ("bytes=1000-", 1000),
+            ("bytes=5000-6000", 1000),
+            ("bytes=-0", 1000),
+            ("bytes=0-", 0),
+            ("bytes=-10", 0),
+        ):
+            with self.subTest(header=header, size=size):
+                self.assertIsNone(requested_range(header, size))
+
+
+if __name__ == "__main__":
+    unittest.main()
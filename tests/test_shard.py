@@ -0,0 +1,76 @@
+"""Tests for splitting the selected files between machines with --shard.
+
+python -m pytest tests
+"""
+
+import argparse
+import unittest
+
+from download import FLP_PLAYLIST, shard, shard_jobs
+
+
+def make_jobs(sizes=None):
+    jobs = [{"source": item["m4a"], "size": None} for item in FLP_PLAYLIST]
+    for job, size in zip(jobs, sizes or []):
+        job["size"] = size
+    return jobs
+
+
+class ShardJobsTest(unittest.TestCase):
+    def assertPartition(self, jobs, count, method):
+        parts = [shard_jobs(jobs, (i, count), method) for i in range(1, count + 1)]
+        sources = [job["source"] for part in parts for job in part]
+        self.assertCountEqual(sources, [job["source"] for job in jobs])
+        for part in parts:
+            # Each part keeps the playlist order
+            self.assertEqual(part, [job for job in jobs if job in part])
+        return parts
+
+    def test_hash(self):
+        jobs = make_jobs()
+        parts = self.assertPartition(jobs, 3, "hash")
+        self.assertTrue(all(parts))
+        # Depends only on the paths, not on local state or the selection
+        other = make_jobs(range(len(jobs)))
+        self.assertEqual(
+            [job["source"] for job in shard_jobs(other[::2], (2, 3))],
+            [job["source"] for job in parts[1] if job in jobs[::2]],
+        )
+
+    def test_size(self):
+        sizes = [(i * 7919) % 1000 + 1 for i in range(len(FLP_PLAYLIST))]
+        jobs = make_jobs(sizes)
+        parts = self.assertPartition(jobs, 4, "size")
+        totals = [sum(job["size"] for job in part) for part in parts]
+        self.assertLessEqual(max(totals) - min(totals), max(sizes))
+        self.assertEqual(parts, [shard_jobs(jobs, (i, 4), "size") for i in range(1, 5)])
+
+    def test_size_ties(self):
+        # Equal sizes are placed by path, whatever order the jobs come in
+        jobs = make_jobs([100] * len(FLP_PLAYLIST))
+        part = shard_jobs(jobs, (1, 2), "size")
+        self.assertEqual(shard_jobs(jobs[::-1], (1, 2), "size"), part[::-1])
+
+    def test_size_unknown(self):
+        jobs = make_jobs([100] * 10)
+        with self.assertRaises(ValueError):
+            shard_jobs(jobs, (1, 2), "size")
+
+    def test_single_part(self):
+        jobs = make_jobs()
+        self.assertEqual(shard_jobs(jobs, (1, 1)), jobs)
+
+
+class ShardOptionTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(shard("2/3"), (2, 3))
+
+    def test_invalid(self):
+        for value in ("0/3", "4/3", "1/0", "1", "a/b"):
+            with self.subTest(value=value):
+                with self.assertRaises(argparse.ArgumentTypeError):
+                    shard(value)
+
+
+if __name__ == "__main__":
+    unittest.main()